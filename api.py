@@ -0,0 +1,234 @@
+"""
+JSON API of the claim checker, for programs: an ASGI app (FastAPI) serving the
+same scheduler, pipeline and caches as the Gradio interface.
+
+Usage:
+    python api.py [--host 0.0.0.0] [--port 8000] [--with-ui]
+
+Endpoints:
+- POST /verify {"claim": ..., "num_articles": 6}: the results of the claim.
+- GET /verify/stream?claim=...&num_articles=6: server-sent events, "queued" while
+  the claim waits for a pipeline, "result" for every article as it is judged, then
+  "done" with all the results, or "error".
+- POST /verify/batch {"claims": [...], "num_articles": 6}: the results of every
+  claim, in order.
+- GET /stats: the statistics of the scheduler and caches.
+
+A result holds the url, publisher, comment, stance and probabilities (agrees,
+disagrees, unrelated) of an article. The requests wait for the pipelines in the
+event loop, without a thread each, so that the server follows many connections at
+once. With `--with-ui`, the Gradio interface is served under /ui by the same
+process.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from app import MAX_PIPELINES, build_interface, scheduler
+from dedup import get_duplicate_index
+from relevance import relevance_filter
+from scheduler import Overloaded
+from search_cache import get_search_cache
+from stance_cache import get_stance_cache
+
+
+# Maximum number of claims of a batch request.
+MAX_BATCH_CLAIMS = int(os.environ.get("CLAIM_CHECKER_API_MAX_BATCH", 64))
+
+
+class VerificationError(Exception):
+    """Raised when the verification of a claim fails."""
+
+
+class ClaimRequest(BaseModel):
+    claim: str = Field(min_length=1)
+    num_articles: int = Field(default=6, ge=1, le=20)
+
+
+class BatchRequest(BaseModel):
+    claims: list[str] = Field(min_length=1, max_length=MAX_BATCH_CLAIMS)
+    num_articles: int = Field(default=6, ge=1, le=20)
+
+
+def result_json(row):
+    return {
+        "url": row["url"],
+        "publisher": row["publisher"],
+        "comment": row["comment"],
+        "stance": row["stance"],
+        "probabilities": row["probabilities"],
+    }
+
+
+async def verify_updates(claim, num_articles):
+    """
+    Verifies the claim through the scheduler of the app.
+
+    Yields:
+    - ("queued", position, estimated wait in seconds) while the claim waits.
+    - ("results", results) with the results found so far, every time a new article
+      is judged.
+
+    Raises:
+    - Overloaded: If the claim is shed.
+    - VerificationError: If the verification fails.
+    """
+    async for update in scheduler.astream(claim, num_articles):
+        if update[0] == "queued":
+            yield update
+            continue
+        rows = update[1]
+        for row in rows:
+            if row.get("message"):
+                raise VerificationError(row["comment"])
+        yield "results", [result_json(row) for row in rows]
+
+
+async def verify_results(claim, num_articles):
+    results = []
+    async for update in verify_updates(claim, num_articles):
+        if update[0] == "results":
+            results = update[1]
+    return results
+
+
+api = FastAPI(title="Claim Verification API")
+
+
+@api.post("/verify")
+async def verify(request: ClaimRequest):
+    try:
+        results = await verify_results(request.claim, request.num_articles)
+    except Overloaded as e:
+        raise HTTPException(503, str(e), headers={"Retry-After": "60"})
+    except VerificationError as e:
+        raise HTTPException(500, str(e))
+    return {"claim": request.claim, "results": results}
+
+
+def event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class UpdatesResponse(StreamingResponse):
+    """
+    Streaming response closing the `updates` of the claim once it is sent, or when
+    the client disconnects, even before the events are iterated, so that the claim
+    is unsubscribed from the scheduler.
+    """
+
+    def __init__(self, content, updates, **kwargs):
+        super().__init__(content, **kwargs)
+        self.updates = updates
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.updates.aclose()
+
+
+@api.get("/verify/stream")
+async def verify_stream(
+    claim: str = Query(min_length=1), num_articles: int = Query(6, ge=1, le=20)
+):
+    updates = verify_updates(claim, num_articles)
+    try:
+        # The first update submits the claim, so that an overload is a 503.
+        first = await anext(updates)
+    except Overloaded as e:
+        raise HTTPException(503, str(e), headers={"Retry-After": "60"})
+    except VerificationError as e:
+        first = e
+    except StopAsyncIteration:
+        first = None
+
+    async def events():
+        sent = set()  # URLs of the articles sent
+        results = []
+        try:
+            update = first
+            while update is not None:
+                if isinstance(update, Exception):
+                    raise update
+                if update[0] == "queued":
+                    _, position, wait = update
+                    yield event("queued", {"position": position, "wait": wait})
+                else:
+                    results = update[1]
+                    for result in results:
+                        if result["url"] not in sent:
+                            sent.add(result["url"])
+                            yield event("result", result)
+                update = await anext(updates, None)
+            yield event("done", {"claim": claim, "results": results})
+        except VerificationError as e:
+            yield event("error", {"error": str(e)})
+
+    return UpdatesResponse(
+        events(),
+        updates,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@api.post("/verify/batch")
+async def verify_batch(request: BatchRequest):
+    """
+    Verifies the claims, at most MAX_PIPELINES at once so that a batch doesn't fill
+    the queue of the scheduler by itself. A claim that fails gets an error instead
+    of results.
+    """
+    slots = asyncio.Semaphore(MAX_PIPELINES)
+
+    async def check(claim):
+        async with slots:
+            try:
+                results = await verify_results(claim, request.num_articles)
+                return {"claim": claim, "results": results, "error": None}
+            except (Overloaded, VerificationError) as e:
+                return {"claim": claim, "results": [], "error": str(e)}
+
+    records = await asyncio.gather(*(check(claim) for claim in request.claims))
+    return {"results": records}
+
+
+@api.get("/stats")
+async def stats():
+    return {
+        "scheduler": scheduler.stats(),
+        "stance_cache": get_stance_cache().stats(),
+        "search_cache": get_search_cache().stats(),
+        "duplicates": get_duplicate_index().stats(),
+        "relevance_filter": relevance_filter.stats(),
+    }
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Claim verification JSON API.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--with-ui", action="store_true", help="Also serve the Gradio app under /ui."
+    )
+    args = parser.parse_args()
+
+    server = api
+    if args.with_ui:
+        import gradio as gr
+
+        server = gr.mount_gradio_app(api, build_interface(), path="/ui")
+    uvicorn.run(server, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,66 @@
-import gradio as gr
-import logging
+import time
 
-from query_articles import query_articles
-from response_handler import parse_result, get_stance
+STARTED_AT = time.time()  # Origin of the startup profile, before the other imports.
 
-# from inference_local import batch_infer_stances
+import argparse
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
 
-import modal
+# gradio, modal and newspaper are imported on first use, to start up faster.
+from dedup import get_duplicate_index
+from pipeline import iterate_async, verify_claim_pipeline
+from relevance import relevance_filter
+from response_handler import get_stance
+from scheduler import ClaimScheduler, Overloaded, limit_concurrency
+from search_cache import get_search_cache
+from sharding import (
+    SHARD_SIZE,
+    ShardedInference,
+    local_starmap,
+    modal_shard_model,
+    modal_starmap,
+)
+from tracing import span
+from wire import COMPACT_WIRE, WireClient
 
+# The console and the file are written by the listener's thread, so that logging
+# never blocks the pipeline.
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.StreamHandler(),  # Logs to console
+    logging.FileHandler("gradio_app.log", delay=True),  # Logs to file
+)
 logging.basicConfig(
     level=logging.DEBUG,
     format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(),  # Logs to console
-        logging.FileHandler("gradio_app.log"),  # Logs to file
-    ],
+    handlers=[logging.handlers.QueueHandler(log_queue)],
 )
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+# Where the stance inference runs: "modal" (remote GPU) or "local" (inference_local).
+INFERENCE = os.environ.get("CLAIM_CHECKER_INFERENCE", "modal")
+
+# Limits of the claim scheduler, see `ClaimScheduler`.
+MAX_PIPELINES = int(os.environ.get("CLAIM_CHECKER_MAX_PIPELINES", 4))
+MAX_GPU_CALLS = int(os.environ.get("CLAIM_CHECKER_MAX_GPU_CALLS", 8))
+MAX_QUEUE = int(os.environ.get("CLAIM_CHECKER_MAX_QUEUE", 16))
+MAX_SUBSCRIBERS = int(os.environ.get("CLAIM_CHECKER_MAX_SUBSCRIBERS", 64))
 
+# Whether to ping the inference backend at launch, so that its model is loaded
+# before the first claim.
+WARM_UP = os.environ.get("CLAIM_CHECKER_WARM_UP", "0") == "1"
+
+gpu_slots = threading.BoundedSemaphore(MAX_GPU_CALLS)
+
+# Seconds spent in each step of the startup, see `record_startup`.
+startup_profile = {}
 
 COLOR_MAP = {
     "supports": "green",
@@ -27,49 +71,205 @@ COLOR_MAP = {
 }
 
 
-def verify_claim(claim, num_articles=6):
-    try:
-        # articles = [(url, scrape_article(url)) for url in urls]
-        articles = query_articles(claim, num_articles)
-        logging.info(f"Scraped {len(articles)} articles.")
+_stance_model = None
+_stream_infer_stances = None
+_wire_client = None
+_inference_lock = threading.Lock()
+
+
+def get_stance_model():
+    """
+    Returns the stance model: the handle of the Modal class, resolved once and
+    reused by all the claims, or the process-resident `inference_local` model.
+    """
+    global _stance_model
+    with _inference_lock:
+        if _stance_model is None:
+            if INFERENCE == "local":
+                from inference_local import stance_model
+            else:
+                import modal
+
+                stance_model = modal.Cls.from_name("claim-checker", "StanceModel")()
+            _stance_model = stance_model
+    return _stance_model
+
+
+def get_stream_infer_stances():
+    """
+    Returns the function streaming the stance results of a claim's articles. At most
+    MAX_GPU_CALLS of them run at once. When CLAIM_CHECKER_SHARD_SIZE is set, the
+    articles are split into shards inferred in parallel, see `ShardedInference`.
+    Otherwise the Modal calls use the compact wire format, see `WireClient`.
+    """
+    global _stream_infer_stances, _wire_client
+    stance_model = get_stance_model()
+    with _inference_lock:
+        if _stream_infer_stances is None:
+            if SHARD_SIZE:
+                if INFERENCE == "local":
+                    starmap = local_starmap(stance_model.batch_infer_pairs)
+                else:
+                    import modal
+
+                    shard_model = modal_shard_model(
+                        modal.Cls.from_name("claim-checker", "StanceModel")
+                    )
+                    starmap = modal_starmap(shard_model.batch_infer_pairs)
+                sharded = ShardedInference(starmap, SHARD_SIZE)
+                stream_infer_stances = sharded.stream_infer_stances
+            elif INFERENCE == "local":
+                stream_infer_stances = stance_model.stream_infer_stances
+            elif COMPACT_WIRE:
+                _wire_client = WireClient(stance_model.stream_payload.remote_gen)
+                stream_infer_stances = _wire_client.stream_infer_stances
+            else:
+                stream_infer_stances = stance_model.stream_infer_stances.remote_gen
+            _stream_infer_stances = limit_concurrency(stream_infer_stances, gpu_slots)
+    return _stream_infer_stances
+
+
+def record_startup(**durations):
+    """Adds the durations (in seconds) of startup steps to the startup profile."""
+    startup_profile.update(durations)
+    logging.info(
+        "Startup profile: "
+        + ", ".join(f"{step} {value:.2f} s" for step, value in startup_profile.items())
+        + "."
+    )
+
+
+def warm_up():
+    """
+    Pings the inference backend, which loads the model (and, for Modal, starts a
+    GPU container), and starts the article extraction processes, so that the first
+    claim doesn't wait for them.
+    """
+    from fetcher import get_extraction_pool, extract_article
 
-        batch_infer_stances = modal.Function.lookup(
-            "claim-checker", "batch_infer_stances"
+    with span("warm_up", inference=INFERENCE) as warm_up_span:
+        extraction = get_extraction_pool().submit(
+            extract_article, "http://localhost/", b"<html></html>"
         )
+        if INFERENCE == "local":
+            get_stance_model().load()
+        else:
+            get_stance_model().stats.remote()
+        extraction.result()
+    record_startup(warm_up=time.time() - warm_up_span.start)
 
-        results = []
-        results_raw = batch_infer_stances.remote(claim, articles)
-        for result_raw, article in zip(results_raw, articles):
-            analyze = parse_result(result_raw)
-            if analyze["error_flag"]:
-                continue
-            stance = get_stance(analyze)
-            color = COLOR_MAP.get(stance, "black")
-            publisher = article["publisher"]  # Extract publisher's name
-            results.append(
-                {
+
+def verify_claim_stream(claim, num_articles=6):
+    """
+    Verifies the claim, yielding the results found so far (in the order of the
+    articles) every time a new article is judged. The first articles are judged
+    while the next ones are still being scraped, see `verify_claim_pipeline`.
+    """
+    time_start = time.time()
+    with span("verify_claim", num_articles=num_articles) as claim_span:
+        try:
+            stream_infer_stances = get_stream_infer_stances()
+
+            results = {}
+            analyses = verify_claim_pipeline(claim, num_articles, stream_infer_stances)
+            for rank, article, analyze in iterate_async(analyses):
+                if analyze["error_flag"]:
+                    continue
+                stance = get_stance(analyze)
+                relevance_filter.record_stance(article, stance)
+                color = COLOR_MAP.get(stance, "black")
+                publisher = article["publisher"]  # Extract publisher's name
+                results[rank] = {
                     "url": article["url"],
                     "publisher": publisher,
                     "comment": analyze["comment"],
                     "stance": stance,
                     "color": color,
+                    "probabilities": {
+                        "agrees": analyze["agrees"],
+                        "disagrees": analyze["disagrees"],
+                        "unrelated": analyze["unrelated"],
+                    },
                 }
-            )
-        print(results)
-        return results
-
-    except Exception as e:
-        error_message = f"Error occurred: {e}"
-        logging.error(error_message, exc_info=True)
-        return [
-            {
-                "url": "N/A",
-                "publisher": "N/A",
-                "comment": error_message,
-                "stance": "N/A",
-                "color": "grey",
-            }
-        ]
+                if len(results) == 1:
+                    time_to_first_row = time.time() - time_start
+                    claim_span.set(time_to_first_row=time_to_first_row)
+                    logging.info(f"Time to first row: {time_to_first_row:.2f} s.")
+                yield [results[i] for i in sorted(results)]
+
+            claim_span.set(rows=len(results))
+            logging.info(f"Total latency: {time.time() - time_start:.2f} s.")
+            if "first_request" not in startup_profile:
+                record_startup(first_request=time.time() - time_start)
+            logging.info(f"Relevance filter: {relevance_filter.stats()}.")
+            logging.info(f"Near-duplicates: {get_duplicate_index().stats()}.")
+            logging.info(f"Search cache: {get_search_cache().stats()}.")
+            if _wire_client is not None:
+                logging.info(f"Inference payloads: {_wire_client.stats()}.")
+            print([results[i] for i in sorted(results)])
+            if not results:
+                yield []
+
+        except Exception as e:
+            claim_span.outcome = "error"
+            error_message = f"Error occurred: {e}"
+            logging.error(error_message, exc_info=True)
+            yield [message_row(error_message)]
+
+
+def message_row(message, color="grey"):
+    """A row of the table giving a message (an error, the queue position)."""
+    return {
+        "url": "N/A",
+        "publisher": "N/A",
+        "comment": message,
+        "stance": "N/A",
+        "color": color,
+        "message": True,
+    }
+
+
+# Shares the verification of identical claims and caps the pipelines running at once.
+scheduler = ClaimScheduler(
+    verify_claim_stream,
+    max_pipelines=MAX_PIPELINES,
+    max_queue=MAX_QUEUE,
+    max_subscribers=MAX_SUBSCRIBERS,
+)
+
+
+def verify_claim_scheduled(claim, num_articles=6):
+    """
+    Verifies the claim through the scheduler, yielding the results found so far, or
+    a row giving the position in the queue while the claim waits.
+    """
+    try:
+        for update in scheduler.stream(claim, num_articles):
+            if update[0] == "queued":
+                _, position, wait = update
+                yield [
+                    message_row(
+                        f"Waiting in queue: position {position}, about {wait:.0f} s.",
+                        color="white",
+                    )
+                ]
+            else:
+                yield update[1]
+    except Overloaded as e:
+        logging.warning(f"Shed claim {claim!r}: {scheduler.stats()}")
+        yield [message_row(str(e))]
+
+
+def verify_claim(claim, num_articles=6):
+    results = []
+    for results in verify_claim_scheduled(claim, num_articles):
+        pass
+    return results
+
+
+def verify_claim_table(claim):
+    for results in verify_claim_scheduled(claim):
+        yield create_table(results)
 
 
 def create_table(results):
@@ -126,15 +326,42 @@ def create_table(results):
         return table_html
 
 
-def main():
-    interface = gr.Interface(
-        fn=lambda claim: create_table(verify_claim(claim)),
+def build_interface():
+    import gradio as gr
+
+    return gr.Interface(
+        fn=verify_claim_table,
         inputs=gr.Textbox(label="Enter a Claim"),
+        # Every request following a claim holds a worker thread, the scheduler sheds
+        # the requests beyond the same bound.
+        concurrency_limit=MAX_SUBSCRIBERS,
         outputs=gr.HTML(create_table([])),
         title="Claim Verification Tool",
         description="Input a claim to verify whether web sources support, contradict, or remain neutral about it. Results include article links, publishers, comment, and stances.",
     )
 
+
+def main():
+    parser = argparse.ArgumentParser(description="Claim Verification Tool.")
+    parser.add_argument(
+        "--profile-startup",
+        metavar="CLAIM",
+        help="Report the startup profile with a first request for CLAIM, then exit.",
+    )
+    args = parser.parse_args()
+    record_startup(imports=time.time() - STARTED_AT)
+
+    time_start = time.time()
+    interface = build_interface()
+    record_startup(interface=time.time() - time_start)
+
+    if args.profile_startup:
+        if WARM_UP:
+            warm_up()
+        verify_claim(args.profile_startup)
+        return
+    if WARM_UP:
+        threading.Thread(target=warm_up, daemon=True).start()
     interface.launch(share=True, debug=False)
 
 
@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+
+CACHE_DIR = os.environ.get("CLAIM_CHECKER_CACHE_DIR", ".cache")
+
+tracking_parameters = ["fbclid", "gclid", "mc_cid", "mc_eid", "ref"]
+
+
+def normalize_url(url):
+    """
+    Normalizes a URL so that the different ways of writing the address of the same
+    article share a single cache entry: lowercase scheme and host, no "www.", no
+    fragment, no tracking parameters, sorted query and no trailing slash.
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[len("www.") :]
+    if parsed.port and parsed.port not in (80, 443):
+        host += f":{parsed.port}"
+    query = sorted(
+        (key, value)
+        for key, value in parse_qsl(parsed.query, keep_blank_values=True)
+        if not key.startswith("utm_") and key not in tracking_parameters
+    )
+    path = parsed.path.rstrip("/") or "/"
+    return urlunparse(
+        (parsed.scheme.lower() or "http", host, path, "", urlencode(query), "")
+    )
+
+
+class ArticleCache:
+    """
+    Persistent cache of scraped articles, stored in a SQLite database.
+
+    Entries are keyed by normalized URL and expire `ttl` seconds after they were
+    fetched. When the cached content exceeds `max_bytes`, the least recently used
+    entries are evicted.
+
+    Parameters:
+    - directory: Directory holding the database file.
+    - ttl: Lifetime of an entry in seconds.
+    - max_bytes: Maximum total size of the cached content.
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl=7 * 24 * 3600, max_bytes=200_000_000):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "articles.sqlite")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS articles (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                title TEXT,
+                content TEXT,
+                publisher TEXT,
+                fetched_at REAL,
+                last_access REAL,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER
+            )
+            """
+        )
+        self._connection.commit()
+
+    def get_entry(self, url):
+        """
+        Returns the cache entry of the URL, even if expired, as a dict with the
+        article fields plus 'fetched_at', 'etag', 'last_modified' and 'expired'.
+        Returns None if the URL is not cached. Doesn't update the hit/miss counters.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT title, content, publisher, fetched_at, etag, last_modified"
+                " FROM articles WHERE key = ?",
+                (normalize_url(url),),
+            ).fetchone()
+        if row is None:
+            return None
+        title, content, publisher, fetched_at, etag, last_modified = row
+        return {
+            "title": title,
+            "content": content,
+            "url": url,
+            "publisher": publisher,
+            "fetched_at": fetched_at,
+            "etag": etag,
+            "last_modified": last_modified,
+            "expired": time.time() - fetched_at > self.ttl,
+        }
+
+    def get(self, url):
+        """Returns the cached article of the URL, or None if missing or expired."""
+        entry = self.get_entry(url)
+        if entry is None or entry["expired"]:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._lock:
+            self._connection.execute(
+                "UPDATE articles SET last_access = ? WHERE key = ?",
+                (time.time(), normalize_url(url)),
+            )
+            self._connection.commit()
+        return {key: entry[key] for key in ["title", "content", "url", "publisher"]}
+
+    def put(self, url, article, etag=None, last_modified=None):
+        now = time.time()
+        size = len(article["content"].encode()) + len(article["title"].encode())
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    normalize_url(url),
+                    url,
+                    article["title"],
+                    article["content"],
+                    article["publisher"],
+                    now,
+                    now,
+                    etag,
+                    last_modified,
+                    size,
+                ),
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        total = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM articles"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._connection.execute(
+            "SELECT key, size FROM articles ORDER BY last_access"
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._connection.executemany("DELETE FROM articles WHERE key = ?", evicted)
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM articles")
+            self._connection.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM articles"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+_article_cache = None
+_article_cache_lock = threading.Lock()
+
+
+def get_article_cache():
+    """Returns the process-wide article cache, created on first use."""
+    global _article_cache
+    with _article_cache_lock:
+        if _article_cache is None:
+            _article_cache = ArticleCache()
+    return _article_cache
@@ -0,0 +1,369 @@
+"""
+Bulk claim checking: reads claims from a JSON-lines file and writes one result
+record per claim to another JSON-lines file, as the claims are verified.
+
+Usage:
+    python batch_check.py claims.jsonl results.jsonl [--num-articles 6]
+    cat claims.jsonl | python batch_check.py - results.jsonl
+
+Each input line is a JSON object with a "claim" and an optional "id" (the line
+number by default), or just the claim as a JSON string. The claims are handled in
+groups: the articles of a group are searched and scraped while the previous group
+is being inferred, each URL is scraped once for all the claims, and the articles
+of all the claims of a group share the same inference batches.
+
+The output file is also the checkpoint: when restarted, the claims whose id already
+has a result in it are skipped, so an interrupted run resumes where it stopped. The
+claims whose result was an error are retried, and their error records removed.
+"""
+
+import argparse
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from article_cache import normalize_url
+from dedup import get_duplicate_index
+from query_articles import query_articles, scrape_article
+from relevance import relevance_filter
+from response_handler import parse_result, get_stance
+from search_cache import get_search_cache
+from sharding import (
+    SHARD_SIZE,
+    ShardedInference,
+    local_starmap,
+    modal_shard_model,
+    modal_starmap,
+)
+from stance_cache import StanceCache, get_stance_cache
+from tracing import span, run_in_context
+from wire import BULK, COMPACT_WIRE, WireClient
+
+
+# Where the stance inference runs: "modal" (remote GPU) or "local" (inference_local).
+INFERENCE = os.environ.get("CLAIM_CHECKER_INFERENCE", "modal")
+
+
+def get_batch_infer_pairs():
+    """
+    Returns the function inferring the stances of (claim, article) pairs, in
+    parallel shards when CLAIM_CHECKER_SHARD_SIZE is set, else in the compact wire
+    format for Modal. The pairs are inferred with the BULK priority, so that the
+    claims of the app's users are served first.
+    """
+    if INFERENCE == "local":
+        from inference_local import batch_infer_pairs
+
+        batch_infer_pairs = functools.partial(batch_infer_pairs, priority=BULK)
+        if SHARD_SIZE:
+            starmap = local_starmap(batch_infer_pairs)
+            return ShardedInference(starmap, SHARD_SIZE).batch_infer_pairs
+        return batch_infer_pairs
+    import modal
+
+    stance_class = modal.Cls.from_name("claim-checker", "StanceModel")
+    stance_model = stance_class()
+    if SHARD_SIZE:
+        shard_model = modal_shard_model(stance_class)
+        starmap = modal_starmap(shard_model.batch_infer_pairs, priority=BULK)
+        return ShardedInference(starmap, SHARD_SIZE).batch_infer_pairs
+    if COMPACT_WIRE:
+        wire_client = WireClient(stance_model.stream_payload.remote_gen)
+        return functools.partial(wire_client.batch_infer_pairs, priority=BULK)
+    return functools.partial(stance_model.batch_infer_pairs.remote, priority=BULK)
+
+
+class SharedScraper:
+    """
+    Scraper with the signature of `scrape_article` that downloads every URL at most
+    once for all the claims of a run. Concurrent requests for the same URL wait for
+    the first download, and the results of the last `max_entries` URLs are kept.
+    """
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()  # normalized URL -> future of the article
+        self._lock = threading.Lock()
+
+    def __call__(self, url, request_timeout=7, cache_entry=None):
+        key = normalize_url(url)
+        with self._lock:
+            future = self._results.get(key)
+            if future is None:
+                self.misses += 1
+                future = self._results[key] = Future()
+                owner = True
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+            else:
+                self.hits += 1
+                self._results.move_to_end(key)
+                owner = False
+
+        if owner:
+            article = None
+            try:
+                article = scrape_article(url, request_timeout, cache_entry)
+            finally:
+                future.set_result(article)
+        article = future.result()
+        # Each claim gets its own copy, as the pipeline annotates the articles.
+        return {**article} if article else None
+
+
+def read_claims(file):
+    """Yields the {"id": ..., "claim": ...} records of a JSON-lines input."""
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"Skipping line {line_number}: {e}")
+            continue
+        if isinstance(record, str):
+            record = {"claim": record}
+        if not isinstance(record, dict) or not record.get("claim"):
+            print(f"Skipping line {line_number}: no claim.")
+            continue
+        yield {"id": record.get("id", line_number), "claim": record["claim"]}
+
+
+def load_checkpoint(path):
+    """
+    Returns the ids of the claims with a result in the output file at `path`.
+    Records with an error don't count, so that their claims are retried. The file
+    is rewritten with one record per id, the last one, without the records with an
+    error nor a line left incomplete by an interruption, so that the retried claims
+    don't leave duplicate ids in it.
+    """
+    if not os.path.exists(path):
+        return set()
+    records = {}
+    with open(path, "rb") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            records[record["id"]] = record
+    records = [record for record in records.values() if record.get("error") is None]
+    with open(path + ".tmp", "w") as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+    os.replace(path + ".tmp", path)
+    return {record["id"] for record in records}
+
+
+def groups_of(records, size):
+    group = []
+    for record in records:
+        group.append(record)
+        if len(group) == size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def result_row(article, result_raw):
+    analyze = parse_result(result_raw)
+    stance = get_stance(analyze)
+    relevance_filter.record_stance(article, stance)
+    return {
+        "url": article["url"],
+        "title": article["title"],
+        "publisher": article["publisher"],
+        "stance": stance,
+        "comment": analyze["comment"],
+        "relevance": article.get("relevance"),
+        "agrees": analyze["agrees"],
+        "disagrees": analyze["disagrees"],
+        "unrelated": analyze["unrelated"],
+    }
+
+
+def infer_group(scraped, batch_infer_pairs, stance_cache):
+    """
+    Infers the stances of the articles of a group of claims in shared batches, and
+    returns the result record of every claim.
+    """
+    records = []
+    pairs = []
+    owners = []  # index of the record of each pair
+    for record, future in scraped:
+        record = {**record, "results": [], "error": None}
+        try:
+            articles = future.result()
+        except Exception as e:
+            record["error"] = f"Error while querying articles: {e}"
+            articles = []
+        pairs += [(record["claim"], article) for article in articles]
+        owners += [len(records)] * len(articles)
+        records.append(record)
+
+    with span("check_claim_group", claims=len(records), articles=len(pairs)):
+        try:
+            results_raw = stance_cache.infer_pairs(pairs, batch_infer_pairs)
+        except Exception as e:
+            for i in set(owners):
+                records[i]["error"] = f"Error while inferring stances: {e}"
+            return records
+
+    for (_, article), i, result_raw in zip(pairs, owners, results_raw):
+        records[i]["results"].append(result_row(article, result_raw))
+    return records
+
+
+def check_claims(
+    claims,
+    num_articles=6,
+    group_size=8,
+    max_workers=4,
+    use_cache=True,
+    batch_infer_pairs=None,
+):
+    """
+    Verifies claims in bulk, yielding the result record of every claim in the order
+    of `claims`.
+
+    Claims are handled in groups of `group_size`. Up to `max_workers` claims of a
+    group are searched and scraped at once, while the previous group is inferred,
+    so that at most two groups are held in memory. Every URL is scraped once for all
+    the claims, and the articles of a group are sent to the model in shared batches.
+
+    Parameters:
+    - claims: Iterable of {"id": ..., "claim": ...} records, see `read_claims`.
+    - num_articles: Number of articles analyzed per claim.
+    - group_size: Number of claims whose articles share inference batches.
+    - max_workers: Number of claims searched and scraped at once.
+    - use_cache: Whether to use the persistent search, article and stance caches.
+    - batch_infer_pairs: Function inferring the stances of (claim, article) pairs,
+      see `get_batch_infer_pairs` for the default.
+
+    Yields:
+    - {"id", "claim", "results", "error"} records, where "results" holds the url,
+      title, publisher, stance, comment and probabilities of every article.
+    """
+    batch_infer_pairs = batch_infer_pairs or get_batch_infer_pairs()
+    stance_cache = get_stance_cache() if use_cache else StanceCache()
+    scraper = SharedScraper()
+
+    def scrape(group):
+        return [
+            (
+                record,
+                executor.submit(
+                    run_in_context(query_articles),
+                    record["claim"],
+                    num_articles,
+                    use_cache=use_cache,
+                    scraper=scraper,
+                ),
+            )
+            for record in group
+        ]
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        scraped = None
+        for group in groups_of(claims, group_size):
+            next_scraped = scrape(group)
+            if scraped is not None:
+                yield from infer_group(scraped, batch_infer_pairs, stance_cache)
+            scraped = next_scraped
+        if scraped is not None:
+            yield from infer_group(scraped, batch_infer_pairs, stance_cache)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        print(f"Shared scraper: {scraper.hits} URLs reused, {scraper.misses} scraped.")
+
+
+def check_file(input_path, output_path, resume=True, **kwargs):
+    """
+    Verifies the claims of the JSON-lines file at `input_path` ("-" for the standard
+    input) and appends their result records to `output_path`, skipping the claims
+    already checked there unless `resume` is False. Other arguments are passed to
+    `check_claims`.
+
+    Returns:
+    - dict: The number of claims checked and failed, and the throughput.
+    """
+    done = load_checkpoint(output_path) if resume else set()
+    if done:
+        print(f"Resuming, {len(done)} claims already checked.")
+
+    input_file = sys.stdin if input_path == "-" else open(input_path)
+    checked = failed = 0
+    time_start = time.time()
+    try:
+        claims = (
+            record for record in read_claims(input_file) if record["id"] not in done
+        )
+        with open(output_path, "a" if resume else "w") as output_file:
+            for record in check_claims(claims, **kwargs):
+                output_file.write(json.dumps(record) + "\n")
+                output_file.flush()
+                checked += 1
+                failed += record["error"] is not None
+                rate = checked / (time.time() - time_start) * 60
+                print(f"{checked} claims checked ({rate:.1f} claims/minute).")
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+
+    elapsed = time.time() - time_start
+    return {
+        "claims": checked,
+        "failed": failed,
+        "elapsed": elapsed,
+        "claims_per_minute": checked / elapsed * 60 if elapsed else None,
+        "relevance_filter": relevance_filter.stats(),
+        "duplicates": get_duplicate_index().stats(),
+        "search_cache": get_search_cache().stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", help='JSON-lines file of claims, "-" for stdin.')
+    parser.add_argument("output", help="JSON-lines file receiving the results.")
+    parser.add_argument("--num-articles", type=int, default=6)
+    parser.add_argument("--group-size", type=int, default=8)
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument(
+        "--restart", action="store_true", help="Overwrite the output, don't resume."
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Don't use the persistent caches."
+    )
+    args = parser.parse_args()
+
+    summary = check_file(
+        args.input,
+        args.output,
+        resume=not args.restart,
+        num_articles=args.num_articles,
+        group_size=args.group_size,
+        max_workers=args.max_workers,
+        use_cache=not args.no_cache,
+    )
+    print(
+        f"Checked {summary['claims']} claims ({summary['failed']} failed) in"
+        f" {summary['elapsed']:.1f} s: {summary['claims_per_minute'] or 0:.1f}"
+        " claims/minute."
+    )
+    print(f"Relevance filter: {summary['relevance_filter']}.")
+    print(f"Near-duplicates: {summary['duplicates']}.")
+    print(f"Search cache: {summary['search_cache']}.")
+
+
+if __name__ == "__main__":
+    main()
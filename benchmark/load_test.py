@@ -0,0 +1,165 @@
+"""
+Load test of the JSON API (api.py) on the offline setup of the benchmark.
+
+Usage:
+    python -m benchmark.load_test [--connections 64] [--requests 512] [--stream]
+
+The API is served by uvicorn in this process, in front of the corpus server and
+the stub model of `benchmark.run`. `connections` clients send the claims of the
+corpus in turn, `requests` requests in all, to POST /verify (or to the server-sent
+events of GET /verify/stream with `--stream`), and the requests per second, the
+latency percentiles and the errors are reported. Only the first requests of a claim
+run the pipeline, the next ones share its run or hit the caches, so that the
+throughput mostly measures the API itself.
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import threading
+import time
+from urllib.parse import urlencode
+
+from benchmark.run import use_corpus
+from benchmark.server import CorpusServer
+
+
+async def http_request(host, port, method, path, body=None):
+    """
+    Sends an HTTP/1.1 request on a new connection and returns the status code and
+    the body of the response, read until the server closes the connection.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    data = json.dumps(body).encode() if body is not None else b""
+    head = (
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n"
+    )
+    writer.write(head.encode() + data)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    await writer.wait_closed()
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split(b" ", 2)[1]), content
+
+
+async def load(host, port, claims, connections, num_requests, num_articles, stream):
+    """Sends the requests from `connections` clients, returns their outcomes."""
+    jobs = iter(range(num_requests))
+    outcomes = []  # (latency, status, number of results)
+
+    async def client():
+        for i in jobs:
+            claim = claims[i % len(claims)]
+            time_start = time.perf_counter()
+            try:
+                if stream:
+                    query = urlencode({"claim": claim, "num_articles": num_articles})
+                    status, content = await http_request(
+                        host, port, "GET", f"/verify/stream?{query}"
+                    )
+                    results = content.count(b"event: result")
+                    if b"event: error" in content:
+                        status = 500
+                else:
+                    status, content = await http_request(
+                        host,
+                        port,
+                        "POST",
+                        "/verify",
+                        {"claim": claim, "num_articles": num_articles},
+                    )
+                    results = (
+                        len(json.loads(content)["results"]) if status == 200 else 0
+                    )
+            except (OSError, ValueError) as e:
+                print(f"Request failed: {e!r}")
+                status, results = None, 0
+            outcomes.append((time.perf_counter() - time_start, status, results))
+
+    await asyncio.gather(*(client() for _ in range(connections)))
+    return outcomes
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--num-articles", type=int, default=3)
+    parser.add_argument("--stream", action="store_true", help="Use the SSE endpoint.")
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--prefill-latency", type=float, default=0.00002)
+    parser.add_argument("--output", help="Also write the report to this JSON file.")
+    args = parser.parse_args()
+
+    corpus_server = CorpusServer().start()
+    use_corpus(corpus_server, args.token_latency, args.prefill_latency)
+
+    import uvicorn
+    from api import api
+    from tracing import summarize
+
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(
+            api, host="127.0.0.1", port=port, log_level="warning", backlog=4096
+        )
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    claims = list(corpus_server.corpus["claims"])
+    print(
+        f"Sending {args.requests} requests from {args.connections} connections"
+        f" ({len(claims)} claims)..."
+    )
+    time_start = time.perf_counter()
+    outcomes = asyncio.run(
+        load(
+            "127.0.0.1",
+            port,
+            claims,
+            args.connections,
+            args.requests,
+            args.num_articles,
+            args.stream,
+        )
+    )
+    elapsed = time.perf_counter() - time_start
+    server.should_exit = True
+    corpus_server.stop()
+
+    statuses = {}
+    for _, status, _ in outcomes:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    report = {
+        "config": vars(args),
+        "requests_per_sec": len(outcomes) / elapsed,
+        "latency": summarize([latency for latency, _, _ in outcomes]),
+        "statuses": statuses,
+        "empty_responses": sum(
+            1 for _, status, n in outcomes if status == 200 and not n
+        ),
+    }
+    latency = report["latency"]
+    print(
+        f"{report['requests_per_sec']:.1f} requests/s, latency p50"
+        f" {latency['p50']:.3f} s, p95 {latency['p95']:.3f} s, p99"
+        f" {latency['p99']:.3f} s, statuses {statuses}."
+    )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Records the search results and article pages of claims into the benchmark corpus.
+
+Usage:
+    python -m benchmark.record "Claim to record" ["Another claim" ...]
+
+This queries Google and downloads the pages, so it needs network access. Only
+plain "http://" versions of the URLs are stored, because the corpus server replays
+the pages as an HTTP proxy.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+import requests
+
+from benchmark.server import CORPUS_DIR, load_corpus
+from query_articles import build_query, fetch_urls_generator
+
+
+def record_claim(corpus, claim, num_urls=20, directory=CORPUS_DIR):
+    urls = []
+    for url in fetch_urls_generator(build_query(claim)):
+        if len(urls) >= num_urls:
+            break
+        url = "http://" + url.split("://", 1)[-1]
+        urls.append(url)
+        try:
+            response = requests.get(url, timeout=10)
+        except requests.RequestException as e:
+            print(f"Failed to download {url}: {e}")
+            continue
+        name = hashlib.sha1(url.encode()).hexdigest()[:16] + ".html"
+        with open(os.path.join(directory, "pages", name), "wb") as file:
+            file.write(response.content)
+        corpus["pages"][url] = {
+            "file": f"pages/{name}",
+            "status": response.status_code,
+            "delay": round(response.elapsed.total_seconds(), 3),
+        }
+        print(f"Recorded {url} ({len(response.content)} bytes).")
+    corpus["claims"][claim] = urls
+
+
+def main(claims):
+    corpus = load_corpus()
+    for claim in claims:
+        record_claim(corpus, claim)
+    with open(os.path.join(CORPUS_DIR, "index.json"), "w") as file:
+        json.dump(corpus, file, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,289 @@
+"""
+Offline benchmark of the claim checking pipeline.
+
+The search results and article pages are replayed from the recorded corpus by a
+local server, and the stance model is replaced by a deterministic stub, so that
+results can be compared between commits without network or GPU.
+
+Usage:
+    python -m benchmark.run [--concurrency 4] [--repeat 2] [--compare previous.json]
+
+Each stage (query_articles, batch_infer_stances, parse_result, verify_claim) is run
+for every claim of the corpus, `repeat` times, with `concurrency` claims at once.
+The report gives the p50/p95/p99 latency, the throughput in claims per second and
+the peak RSS of each stage, plus the per-span statistics of the tracing module.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmark.server import CorpusServer
+
+
+def current_rss():
+    """Returns the resident set size of the process, in bytes."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakRSS:
+    """Samples the RSS of the process in the background to find its peak."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stopped = threading.Event()
+
+    def _sample(self):
+        while not self._stopped.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stopped.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def run_stage(name, function, claims, concurrency, repeat):
+    """
+    Calls `function(claim)` for every claim, `repeat` times, with `concurrency`
+    calls at once, and returns the statistics of the stage and the last result of
+    each claim.
+    """
+    from tracing import summarize
+
+    jobs = [claim for _ in range(repeat) for claim in claims]
+    latencies = []
+    errors = 0
+    results = {}
+
+    def job(claim):
+        nonlocal errors
+        time_start = time.perf_counter()
+        try:
+            results[claim] = function(claim)
+        except Exception as e:
+            errors += 1
+            print(f"{name} failed for {claim!r}: {e}")
+        latencies.append(time.perf_counter() - time_start)
+
+    print(f"Running {name} ({len(jobs)} claims, concurrency {concurrency})...")
+    with PeakRSS() as rss:
+        time_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(job, jobs))
+        elapsed = time.perf_counter() - time_start
+
+    stats = summarize(latencies)
+    stats.update(
+        errors=errors,
+        claims_per_sec=len(jobs) / elapsed,
+        peak_rss_mb=rss.peak / 2**20,
+    )
+    return stats, results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def use_corpus(server, token_latency, prefill_latency, trace_file=None):
+    """
+    Routes the pipeline to the local corpus server and stub model, with empty
+    caches. This has to happen before the pipeline modules are imported, as they
+    read it on import. Returns the `inference_local` module, its model loaded.
+    """
+    os.environ["http_proxy"] = os.environ["HTTP_PROXY"] = server.address
+    os.environ["no_proxy"] = os.environ["NO_PROXY"] = "127.0.0.1,localhost"
+    os.environ["CLAIM_CHECKER_SEARCH_ENDPOINT"] = server.search_endpoint
+    os.environ["CLAIM_CHECKER_CACHE_DIR"] = tempfile.mkdtemp(
+        prefix="claim-checker-benchmark-"
+    )
+    os.environ["CLAIM_CHECKER_INFERENCE"] = "local"
+    os.environ["CLAIM_CHECKER_TRACE_FILE"] = trace_file or ""
+
+    import inference_local
+    from benchmark.stub_model import load_stub_model
+
+    inference_local.load_model = lambda: load_stub_model(token_latency, prefill_latency)
+    inference_local.stance_model.load()
+    # The real model imports the prefix cache's transformers classes when loaded, do
+    # it now rather than in the first timed claim.
+    from transformers import DynamicCache
+
+    return inference_local
+
+
+def run(args):
+    server = CorpusServer().start()
+    inference_local = use_corpus(
+        server, args.token_latency, args.prefill_latency, args.trace_file
+    )
+
+    import tracing
+    from query_articles import query_articles
+    from response_handler import parse_result, get_stance
+    from search_cache import get_search_cache
+    from wire import WireClient
+
+    claims = list(server.corpus["claims"])
+    stages = {}
+
+    stages["query_articles"], articles = run_stage(
+        "query_articles",
+        lambda claim: query_articles(claim, args.num_articles, use_cache=False),
+        claims,
+        args.concurrency,
+        args.repeat,
+    )
+    stages["batch_infer_stances"], results_raw = run_stage(
+        "batch_infer_stances",
+        lambda claim: inference_local.batch_infer_stances(claim, articles[claim]),
+        claims,
+        args.concurrency,
+        args.repeat,
+    )
+    wire_client = WireClient(inference_local.stream_payload, measure_pickled=True)
+    stages["wire_infer_stances"], _ = run_stage(
+        "wire_infer_stances",
+        lambda claim: wire_client.batch_infer_stances(claim, articles[claim]),
+        claims,
+        args.concurrency,
+        args.repeat,
+    )
+    stages["parse_result"], _ = run_stage(
+        "parse_result",
+        lambda claim: [get_stance(parse_result(raw)) for raw in results_raw[claim]],
+        claims,
+        args.concurrency,
+        args.repeat,
+    )
+
+    import app
+
+    stages["verify_claim"], _ = run_stage(
+        "verify_claim",
+        lambda claim: app.verify_claim(claim, args.num_articles),
+        claims,
+        args.concurrency,
+        args.repeat,
+    )
+    server.stop()
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "config": vars(args),
+        "stages": stages,
+        "spans": tracing.summary(),
+        "inference": inference_local.stance_model.stats(),
+        "search_cache": get_search_cache().stats(),
+        "wire": wire_client.stats(),
+    }
+
+
+def compare(previous, current):
+    """Prints the change of the main metrics of every stage between two reports."""
+    print(f"Comparing with {previous.get('commit')}:")
+    for name, stage in current["stages"].items():
+        before = previous["stages"].get(name)
+        if before is None:
+            continue
+        changes = []
+        for key in ["p50", "p95", "claims_per_sec", "peak_rss_mb"]:
+            if before[key]:
+                change = (stage[key] - before[key]) / before[key] * 100
+                changes.append(
+                    f"{key} {before[key]:.3f} -> {stage[key]:.3f} ({change:+.1f}%)"
+                )
+        print(f"  {name}: " + ", ".join(changes))
+
+
+def print_report(report):
+    print(f"{'stage':<22}{'p50':>9}{'p95':>9}{'p99':>9}{'claims/s':>10}{'RSS MB':>9}")
+    for name, stage in report["stages"].items():
+        print(
+            f"{name:<22}{stage['p50']:>9.3f}{stage['p95']:>9.3f}{stage['p99']:>9.3f}"
+            f"{stage['claims_per_sec']:>10.2f}{stage['peak_rss_mb']:>9.1f}"
+        )
+    scheduler = report.get("inference", {}).get("scheduler")
+    if scheduler and scheduler["batches"]:
+        print(
+            f"{scheduler['batches']} GPU batches, {scheduler['batch_fill_ratio']:.0%}"
+            f" full, {scheduler['mean_queue_depth']:.1f} prompts queued and"
+            f" {scheduler['mean_wait']:.2f} s of wait per prompt on average."
+        )
+    wire = report.get("wire")
+    if wire and wire["calls"]:
+        print(
+            f"Wire format: {wire['request_bytes'] / wire['calls']:.0f} bytes sent per"
+            f" call instead of {wire['pickled_bytes'] / wire['calls']:.0f} pickled,"
+            f" {wire['response_bytes'] / wire['calls']:.0f} bytes received."
+        )
+    search_cache = report.get("search_cache")
+    if search_cache and search_cache["hit_ratio"] is not None:
+        print(
+            f"Search cache: {search_cache['hit_ratio']:.0%} of the pages cached,"
+            f" {search_cache['searches_avoided']} searches avoided."
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=2)
+    parser.add_argument("--num-articles", type=int, default=6)
+    parser.add_argument(
+        "--token-latency", type=float, default=0.02, help="Stub decode step, in s."
+    )
+    parser.add_argument(
+        "--prefill-latency", type=float, default=0.00002, help="Stub per prompt token."
+    )
+    parser.add_argument("--output", help="JSON report, benchmark/results/ by default.")
+    parser.add_argument("--compare", help="Previous JSON report to compare with.")
+    parser.add_argument("--trace-file", help="Also write the spans to this file.")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+
+    output = args.output or os.path.join(
+        os.path.dirname(__file__),
+        "results",
+        f"{(report['commit'] or 'local')[:8]}.json",
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Report saved to {output}.")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import json
+import os
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), "corpus")
+
+
+def load_corpus(directory=CORPUS_DIR):
+    """
+    Loads the corpus index: the recorded search results of each claim ("claims",
+    claim -> ordered list of URLs) and the recorded pages ("pages", URL -> file of
+    the HTML page, relative to the corpus directory, with an optional "delay" in
+    seconds and "status" code).
+    """
+    with open(os.path.join(directory, "index.json")) as file:
+        return json.load(file)
+
+
+class CorpusServer:
+    """
+    Local HTTP server replaying the corpus.
+
+    It answers the search queries of `query_articles.HTTPSearchBackend` at
+    `search_endpoint`, with the recorded URLs of the claim quoted at the start of
+    the query. It also acts as an HTTP proxy serving the recorded pages, so that the
+    scraper can be pointed at it with the `http_proxy` environment variable and still
+    see the original URLs (and hosts) of the articles. URLs missing from the corpus
+    answer 404.
+    """
+
+    def __init__(self, directory=CORPUS_DIR, host="127.0.0.1", port=0):
+        self.directory = directory
+        self.corpus = load_corpus(directory)
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                url = urlparse(self.path)
+                if url.path == "/search" and url.hostname in (None, host):
+                    self.reply(
+                        200,
+                        json.dumps(server.search(url.query)).encode(),
+                        "application/json",
+                    )
+                    return
+                page = server.corpus["pages"].get(self.path)
+                if page is None:
+                    self.reply(404, b"Not found", "text/plain")
+                    return
+                time.sleep(page.get("delay", 0))
+                with open(os.path.join(server.directory, page["file"]), "rb") as file:
+                    self.reply(
+                        page.get("status", 200), file.read(), "text/html; charset=utf-8"
+                    )
+
+            def reply(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.address = f"http://{host}:{self._server.server_port}"
+        self.search_endpoint = f"{self.address}/search"
+
+    def search(self, query_string):
+        parameters = parse_qs(query_string)
+        query = parameters.get("q", [""])[0]
+        start = int(parameters.get("start", ["0"])[0])
+        num = int(parameters.get("num", ["10"])[0])
+        match = re.match(r'\s*"(.+?)"', query)
+        claim = match.group(1) if match else query
+        return self.corpus["claims"].get(claim, [])[start : start + num]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
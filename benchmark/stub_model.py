@@ -0,0 +1,207 @@
+import hashlib
+import re
+import threading
+import time
+
+import torch
+
+TOKEN_PATTERN = re.compile(r"\s+|\w+|[^\w\s]")
+
+STANCES = [
+    ("The article presents evidence in favor of the claim.", 80, 10, 10),
+    ("The article argues against the claim with several counterexamples.", 10, 80, 10),
+    ("The article discusses arguments on both sides of the claim.", 45, 40, 15),
+    ("The article does not discuss the claim or closely related topics.", 5, 5, 90),
+]
+
+
+class StubBatch(dict):
+    def to(self, device):
+        return self
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class StubTokenizer:
+    """
+    Deterministic stand-in for the model's tokenizer. Tokens are words, punctuation
+    marks and runs of whitespace, so decoding gives back the exact text.
+    """
+
+    def __init__(self):
+        self.pad_token = "<pad>"
+        self.eos_token = "</s>"
+        self.padding_side = "right"
+        self._ids = {"<pad>": 0, "</s>": 1}
+        self._tokens = ["<pad>", "</s>"]
+        self._lock = threading.Lock()
+
+    @property
+    def pad_token_id(self):
+        return self._ids[self.pad_token]
+
+    @property
+    def eos_token_id(self):
+        return self._ids[self.eos_token]
+
+    def encode(self, text, add_special_tokens=False):
+        ids = []
+        with self._lock:
+            for token in TOKEN_PATTERN.findall(text):
+                if token not in self._ids:
+                    self._ids[token] = len(self._tokens)
+                    self._tokens.append(token)
+                ids.append(self._ids[token])
+        return ids
+
+    def __call__(
+        self, text, add_special_tokens=True, return_tensors=None, padding=False
+    ):
+        if isinstance(text, str):
+            ids = self.encode(text)
+            return StubBatch(input_ids=ids, attention_mask=[1] * len(ids))
+        ids = [self.encode(item) for item in text]
+        if return_tensors is None:
+            return StubBatch(
+                input_ids=ids, attention_mask=[[1] * len(item) for item in ids]
+            )
+        length = max(len(item) for item in ids)
+        input_ids, attention_mask = [], []
+        for item in ids:
+            padding_ids = [self.pad_token_id] * (length - len(item))
+            mask = [1] * len(item)
+            if self.padding_side == "left":
+                input_ids.append(padding_ids + item)
+                attention_mask.append([0] * len(padding_ids) + mask)
+            else:
+                input_ids.append(item + padding_ids)
+                attention_mask.append(mask + [0] * len(padding_ids))
+        return StubBatch(
+            input_ids=torch.tensor(input_ids),
+            attention_mask=torch.tensor(attention_mask),
+        )
+
+    def apply_chat_template(
+        self, messages, tokenize=False, add_generation_prompt=False, return_tensors=None
+    ):
+        text = "".join(
+            f"<|{message['role']}|>\n{message['content']}\n" for message in messages
+        )
+        if add_generation_prompt:
+            text += "<|assistant|>\n"
+        if tokenize:
+            return torch.tensor([self.encode(text)])
+        return text
+
+    def decode(self, ids, skip_special_tokens=False):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        special = {self.pad_token_id, self.eos_token_id}
+        return "".join(
+            self._tokens[i] for i in ids if not (skip_special_tokens and i in special)
+        )
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return [self.decode(ids, skip_special_tokens) for ids in sequences]
+
+
+class StubModel:
+    """
+    Deterministic stand-in for the stance model.
+
+    The response to a prompt is a well-formed stance table picked from the hash of
+    the prompt, followed by some rambling like the real model does. Generation
+    sleeps `prefill_latency` per prompt token and `token_latency` per decoding step
+    (shared by all the prompts of a batch, like on a GPU), so that benchmarks see
+    realistic relative costs without a model. Like a GPU, it runs one call at a
+    time, concurrent calls wait for their turn. Stopping criteria are evaluated after
+    every step, and the prompt tokens found in `past_key_values` are not prefilled
+    again.
+    """
+
+    def __init__(self, tokenizer, token_latency=0.02, prefill_latency=0.00002):
+        self.tokenizer = tokenizer
+        self.token_latency = token_latency
+        self.prefill_latency = prefill_latency
+        self._lock = threading.Lock()
+
+    def respond(self, prompt):
+        digest = int(hashlib.sha256(prompt.encode()).hexdigest(), 16)
+        comment, agrees, disagrees, unrelated = STANCES[digest % len(STANCES)]
+        return (
+            f"**Overall Comment:**  \n{comment}\n\n"
+            "| Label              | Probability |\n"
+            "|--------------------|-------------|\n"
+            f"| Agrees             | {agrees}%         |\n"
+            f"| Disagrees          | {disagrees}%         |\n"
+            f"| Unrelated          | {unrelated}%         |\n"
+            "| An error occurred  | 0%          |\n\n"
+            f"In summary, {comment[0].lower()}{comment[1:]} The article's arguments"
+            " were weighed against the claim, considering the evidence presented, the"
+            " sources cited and the tone of the author, to produce the probabilities"
+            " of the table above."
+        )
+
+    def __call__(self, input_ids, past_key_values=None, **kwargs):
+        """Prefills the tokens into the KV cache, as done by the prefix cache."""
+        with self._lock:
+            time.sleep(self.prefill_latency * input_ids.numel())
+        if past_key_values is not None:
+            states = torch.zeros(len(input_ids), 1, input_ids.shape[1], 1)
+            past_key_values.update(states, states, layer_idx=0)
+        return StubBatch(past_key_values=past_key_values)
+
+    def generate(self, input_ids, **kwargs):
+        with self._lock:
+            return self._generate(input_ids, **kwargs)
+
+    def _generate(
+        self,
+        input_ids,
+        attention_mask=None,
+        max_new_tokens=256,
+        stopping_criteria=(),
+        past_key_values=None,
+        **kwargs,
+    ):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        tokenizer = self.tokenizer
+        pad_token_id = kwargs.get("pad_token_id", tokenizer.pad_token_id)
+        responses = [
+            tokenizer.encode(self.respond(tokenizer.decode(ids[mask.bool()])))
+            + [tokenizer.eos_token_id]
+            for ids, mask in zip(input_ids, attention_mask)
+        ]
+        cached = past_key_values.get_seq_length() if past_key_values else 0
+        time.sleep(
+            self.prefill_latency * (int(attention_mask.sum()) - cached * len(input_ids))
+        )
+
+        generated = [[] for _ in responses]
+        finished = [False] * len(responses)
+        steps = 0
+        while steps < max_new_tokens and not all(finished):
+            for i, response in enumerate(responses):
+                if finished[i] or steps >= len(response):
+                    finished[i] = True
+                    generated[i].append(pad_token_id)
+                else:
+                    generated[i].append(response[steps])
+            steps += 1
+            time.sleep(self.token_latency)
+            sequences = torch.cat([input_ids, torch.tensor(generated)], dim=1)
+            for criterion in stopping_criteria:
+                done = criterion(sequences, None)
+                finished = [a or bool(b) for a, b in zip(finished, done)]
+        return torch.cat([input_ids, torch.tensor(generated)], dim=1)
+
+
+def load_stub_model(token_latency=0.02, prefill_latency=0.00002):
+    """Returns a (model, tokenizer) pair, like `inference_local.load_model`."""
+    tokenizer = StubTokenizer()
+    return StubModel(tokenizer, token_latency, prefill_latency), tokenizer
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from article_cache import CACHE_DIR
+from stance_cache import content_hash
+
+
+# Estimated Jaccard similarity of the word shingles of two articles above which
+# they are near-duplicates, 0 disables the detection.
+DUPLICATE_THRESHOLD = float(os.environ.get("CLAIM_CHECKER_DUPLICATE_THRESHOLD", 0.8))
+
+PRIME = (1 << 61) - 1
+
+
+def shingles(text, size=5):
+    """The sequences of `size` consecutive lowercase words of the text."""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+class DuplicateIndex:
+    """
+    Persistent MinHash/LSH index of the scraped articles, to recognize the copies of
+    a story published by several sites (wire stories, press releases) even if their
+    text slightly differs.
+
+    The MinHash signature of an article estimates the Jaccard similarity of its
+    word shingles with the ones of any other article. Signatures are split into
+    `bands` bands, and articles sharing a band are compared: above `threshold`,
+    the new article is a near-duplicate of the first article of its group, whose
+    content hash it takes as `duplicate_of`. The stance cache keys the results on
+    it, so that the copies of a story are inferred once per claim, including the
+    copies found for later claims. The oldest articles are forgotten beyond
+    `max_entries`.
+
+    Parameters:
+    - directory: Directory holding the database file.
+    - threshold: Minimum estimated similarity of near-duplicates, 0 disables them.
+    - num_permutations: Length of the signatures.
+    - bands: Number of bands of the signatures, more bands find less similar pairs.
+    - shingle_size: Number of words per shingle.
+    - max_entries: Maximum number of articles in the index.
+    """
+
+    def __init__(
+        self,
+        directory=CACHE_DIR,
+        threshold=DUPLICATE_THRESHOLD,
+        num_permutations=64,
+        bands=16,
+        shingle_size=5,
+        max_entries=100_000,
+    ):
+        if num_permutations % bands:
+            raise ValueError("The signature length must be a multiple of the bands.")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_permutations // bands
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        rng = random.Random(0)  # The same permutations for every process.
+        self.permutations = [
+            (rng.randrange(1, PRIME), rng.randrange(PRIME))
+            for _ in range(num_permutations)
+        ]
+        self.checked = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "duplicates.sqlite"), check_same_thread=False
+        )
+        self._connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                key TEXT PRIMARY KEY,
+                duplicate_of TEXT,
+                url TEXT,
+                signature TEXT,
+                created_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS buckets (bucket TEXT, key TEXT);
+            CREATE INDEX IF NOT EXISTS buckets_bucket ON buckets (bucket);
+            """
+        )
+        self._connection.commit()
+
+    def signature(self, text):
+        """Returns the MinHash signature of the text, None if it has no words."""
+        hashes = [
+            int.from_bytes(
+                hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big"
+            )
+            for shingle in shingles(text, self.shingle_size)
+        ]
+        if not hashes:
+            return None
+        return [min((a * h + b) % PRIME for h in hashes) for a, b in self.permutations]
+
+    def buckets(self, signature):
+        return [
+            f"{band}:"
+            + ",".join(map(str, signature[band * self.rows : (band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def similarity(self, signature, other):
+        return sum(a == b for a, b in zip(signature, other)) / len(signature)
+
+    def find(self, article):
+        """
+        Returns the content hash of the first article of the near-duplicate group of
+        the article, and adds the article to the index. Returns None if it isn't a
+        near-duplicate of an article in the index.
+        """
+        key = content_hash(article["content"])
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT duplicate_of FROM fingerprints WHERE key = ?", (key,)
+            ).fetchone()
+        if row:
+            return row[0]
+
+        signature = self.signature(article["content"])
+        if signature is None:
+            return None
+        buckets = self.buckets(signature)
+        with self._lock:
+            candidates = self._connection.execute(
+                "SELECT fingerprints.key, duplicate_of, signature FROM fingerprints"
+                " JOIN buckets ON buckets.key = fingerprints.key"
+                f" WHERE bucket IN ({','.join('?' * len(buckets))})",
+                buckets,
+            ).fetchall()
+            best = None
+            for other, other_duplicate_of, other_signature in candidates:
+                similarity = self.similarity(signature, json.loads(other_signature))
+                if similarity >= self.threshold and (
+                    best is None or similarity > best[0]
+                ):
+                    best = (similarity, other_duplicate_of or other)
+            duplicate_of = best[1] if best else None
+            self._connection.execute(
+                "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    duplicate_of,
+                    article.get("url"),
+                    json.dumps(signature),
+                    time.time(),
+                ),
+            )
+            self._connection.executemany(
+                "INSERT INTO buckets VALUES (?, ?)",
+                [(bucket, key) for bucket in buckets],
+            )
+            self._prune()
+            self._connection.commit()
+        return duplicate_of
+
+    def _prune(self):
+        """
+        Forgets the oldest articles beyond `max_entries`, and a tenth more of them so
+        that it doesn't happen at every insertion.
+        """
+        (count,) = self._connection.execute(
+            "SELECT COUNT(*) FROM fingerprints"
+        ).fetchone()
+        if count <= self.max_entries:
+            return
+        self._connection.execute(
+            "DELETE FROM fingerprints WHERE key IN (SELECT key FROM fingerprints"
+            " ORDER BY created_at LIMIT ?)",
+            (count - self.max_entries + self.max_entries // 10,),
+        )
+        self._connection.execute(
+            "DELETE FROM buckets WHERE key NOT IN (SELECT key FROM fingerprints)"
+        )
+
+    def annotate(self, article):
+        """
+        Sets the `duplicate_of` field of the article if it is a near-duplicate of an
+        article in the index. Returns whether it is one.
+        """
+        if self.threshold <= 0:
+            return False
+        duplicate_of = self.find(article)
+        with self._lock:
+            self.checked += 1
+            if duplicate_of:
+                self.duplicates += 1
+        if duplicate_of:
+            article["duplicate_of"] = duplicate_of
+        return bool(duplicate_of)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "duplicate_rate": (
+                    self.duplicates / self.checked if self.checked else None
+                ),
+            }
+
+
+_duplicate_index = None
+_duplicate_index_lock = threading.Lock()
+
+
+def get_duplicate_index():
+    """Returns the process-wide duplicate index, persisted in CACHE_DIR."""
+    global _duplicate_index
+    with _duplicate_index_lock:
+        if _duplicate_index is None:
+            _duplicate_index = DuplicateIndex()
+    return _duplicate_index
@@ -0,0 +1,144 @@
+import multiprocessing
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+USER_AGENT = "Mozilla/5.0 (compatible; claim-checker)"
+
+
+class HTTPFetcher:
+    """
+    HTTP client shared by all the scrapers of the process.
+
+    Connections are pooled and kept alive between requests to the same host, at most
+    `max_per_host` requests run at once per host (the others wait for a slot), and
+    responses are downloaded compressed and given up on past `max_bytes` bytes of
+    content. Requests are conditional when the validators of a previous response
+    are given.
+
+    Parameters:
+    - max_per_host: Maximum number of concurrent requests (and kept-alive
+      connections) per host.
+    - max_bytes: Maximum size of the decompressed content of a response.
+    - max_hosts: Number of hosts whose connections are kept alive.
+    """
+
+    def __init__(self, max_per_host=4, max_bytes=5_000_000, max_hosts=100):
+        self.max_per_host = max_per_host
+        self.max_bytes = max_bytes
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(
+            {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"}
+        )
+        self._host_slots = defaultdict(
+            lambda: threading.BoundedSemaphore(self.max_per_host)
+        )
+        self._lock = threading.Lock()
+
+    def fetch(self, url, timeout=7, etag=None, last_modified=None):
+        """
+        Downloads the page at `url` within `timeout` seconds.
+
+        Returns:
+        - dict: The "status" code, the raw "html" bytes (None on "304 Not
+          Modified"), and the "etag" and "last_modified" validators of the page.
+
+        Raises:
+        - requests.RequestException: If the request fails or the status is an error.
+        - ValueError: If the page is larger than `max_bytes`.
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        deadline = monotonic() + timeout
+        with self._lock:
+            slot = self._host_slots[urlparse(url).hostname]
+        with slot:
+            with self.session.get(
+                url, headers=headers, timeout=timeout, stream=True
+            ) as response:
+                validators = {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+                if response.status_code == 304:
+                    return {
+                        "status": 304,
+                        "html": None,
+                        "etag": validators["etag"] or etag,
+                        "last_modified": validators["last_modified"] or last_modified,
+                    }
+                response.raise_for_status()
+                declared = response.headers.get("Content-Length", "")
+                if declared.isdigit() and int(declared) > self.max_bytes:
+                    raise ValueError(f"Page larger than {self.max_bytes} bytes.")
+                chunks = []
+                size = 0
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ValueError(f"Page larger than {self.max_bytes} bytes.")
+                    if monotonic() > deadline:
+                        raise requests.Timeout(f"Download took over {timeout} s.")
+                    chunks.append(chunk)
+        return {"status": response.status_code, "html": b"".join(chunks), **validators}
+
+
+def extract_article(url, html):
+    """
+    Extracts the title and text of an article from the raw bytes of its page. CPU
+    heavy, it runs in the extraction process pool.
+    """
+    from newspaper import Article
+
+    article = Article(url)
+    article.download(input_html=html)
+    article.parse()
+    return {"title": article.title, "content": article.text}
+
+
+_fetcher = None
+_extraction_pool = None
+_lock = threading.Lock()
+
+
+def get_fetcher():
+    """Returns the process-wide HTTP fetcher, created on first use."""
+    global _fetcher
+    with _lock:
+        if _fetcher is None:
+            _fetcher = HTTPFetcher()
+    return _fetcher
+
+
+def get_extraction_pool():
+    """
+    Returns the process pool running `extract_article`, with a process per core,
+    created on first use.
+    """
+    global _extraction_pool
+    with _lock:
+        if _extraction_pool is None:
+            # Forking the threads of the app is unsafe, the workers are forked from
+            # a clean server process that imports newspaper once for all of them.
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["newspaper"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _extraction_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(), mp_context=context
+            )
+    return _extraction_pool
@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+
+
+# GGUF export of the model, e.g. made with unsloth's `save_pretrained_gguf`.
+GGUF_MODEL = os.environ.get("CLAIM_CHECKER_GGUF_MODEL")
+# Threads used by llama.cpp for the prompts and the generation.
+CPU_THREADS = int(os.environ.get("CLAIM_CHECKER_CPU_THREADS", os.cpu_count() or 1))
+
+
+class LlamaCppBatch(dict):
+    def to(self, device):
+        return self
+
+
+class LlamaCppTokenizer:
+    """
+    Tokenizer of a llama.cpp model with the interface of the transformers tokenizer
+    used by `inference_local`: encoding, batch padding, decoding and the chat
+    template stored in the GGUF file. The tensors are NumPy arrays, so that neither
+    torch nor transformers are needed.
+    """
+
+    def __init__(self, llm):
+        from llama_cpp.llama_chat_format import Jinja2ChatFormatter
+
+        template = llm.metadata.get("tokenizer.chat_template")
+        if not template:
+            raise ValueError(
+                "The GGUF model has no chat template (tokenizer.chat_template"
+                " metadata), export it with its tokenizer."
+            )
+        self.llm = llm
+        self.bos_token = self._text(llm.token_bos())
+        self.eos_token = self._text(llm.token_eos())
+        self.pad_token = None
+        self.padding_side = "right"
+        self.chat_formatters = {
+            add_generation_prompt: Jinja2ChatFormatter(
+                template=template,
+                eos_token=self.eos_token,
+                bos_token=self.bos_token,
+                add_generation_prompt=add_generation_prompt,
+            )
+            for add_generation_prompt in [False, True]
+        }
+
+    def _text(self, token):
+        return self.llm.detokenize([token], special=True).decode(errors="ignore")
+
+    @property
+    def pad_token_id(self):
+        return self.llm.token_eos()
+
+    @property
+    def eos_token_id(self):
+        return self.llm.token_eos()
+
+    def encode(self, text, add_special_tokens=False):
+        # Special tokens written by the chat template are parsed as such.
+        return self.llm.tokenize(
+            text.encode(), add_bos=add_special_tokens, special=True
+        )
+
+    def __call__(
+        self, text, add_special_tokens=True, return_tensors=None, padding=False
+    ):
+        import numpy
+
+        if isinstance(text, str):
+            ids = self.encode(text, add_special_tokens)
+            return LlamaCppBatch(input_ids=ids, attention_mask=[1] * len(ids))
+        ids = [self.encode(item, add_special_tokens) for item in text]
+        if return_tensors is None:
+            return LlamaCppBatch(
+                input_ids=ids, attention_mask=[[1] * len(item) for item in ids]
+            )
+        length = max(len(item) for item in ids)
+        input_ids, attention_mask = [], []
+        for item in ids:
+            padding_ids = [self.pad_token_id] * (length - len(item))
+            mask = [1] * len(item)
+            if self.padding_side == "left":
+                input_ids.append(padding_ids + item)
+                attention_mask.append([0] * len(padding_ids) + mask)
+            else:
+                input_ids.append(item + padding_ids)
+                attention_mask.append(mask + [0] * len(padding_ids))
+        return LlamaCppBatch(
+            input_ids=numpy.array(input_ids), attention_mask=numpy.array(attention_mask)
+        )
+
+    def apply_chat_template(
+        self, messages, tokenize=False, add_generation_prompt=False, return_tensors=None
+    ):
+        import numpy
+
+        formatter = self.chat_formatters[add_generation_prompt]
+        text = formatter(messages=messages).prompt
+        if tokenize:
+            return numpy.array([self.encode(text)])
+        return text
+
+    def decode(self, ids, skip_special_tokens=False):
+        if hasattr(ids, "tolist"):
+            ids = ids.tolist()
+        text = self.llm.detokenize(ids, special=not skip_special_tokens)
+        return text.decode(errors="ignore")
+
+    def batch_decode(self, sequences, skip_special_tokens=False):
+        return [self.decode(ids, skip_special_tokens) for ids in sequences]
+
+
+class LlamaCppModel:
+    """
+    llama.cpp model with the `generate` interface of a transformers model, so that
+    `inference_local` runs it on the CPU unchanged.
+
+    There is no real batching: the prompts of a batch are generated one after the
+    other in the same llama.cpp context, which reuses the keys and values of the
+    prefix they share with the previous prompt (the instructions and, usually, the
+    claim), so it declares that it doesn't support `PrefixCache`. The stopping
+    criteria are evaluated after every token, and the decoding speed of every batch
+    is reported.
+    """
+
+    supports_prefix_cache = False
+
+    def __init__(self, llm):
+        import llama_cpp
+
+        self.llm = llm
+        self._vocab = llama_cpp.llama_model_get_vocab(llm.model)
+        self._lock = threading.Lock()  # A llama.cpp context runs one prompt at once.
+
+    def is_end(self, token):
+        """Whether the token ends the generation (end of sequence or of turn)."""
+        import llama_cpp
+
+        return token == self.llm.token_eos() or llama_cpp.llama_vocab_is_eog(
+            self._vocab, token
+        )
+
+    def generate(
+        self,
+        input_ids,
+        attention_mask=None,
+        max_new_tokens=256,
+        temperature=1.0,
+        repetition_penalty=1.0,
+        min_p=0.05,
+        pad_token_id=None,
+        stopping_criteria=(),
+        **kwargs,
+    ):
+        import numpy
+
+        if attention_mask is None:
+            attention_mask = numpy.ones_like(input_ids)
+        if pad_token_id is None:
+            pad_token_id = self.llm.token_eos()
+
+        def sequences():
+            length = max(len(ids) for ids in generated)
+            padded = [ids + [pad_token_id] * (length - len(ids)) for ids in generated]
+            return numpy.concatenate(
+                [input_ids, numpy.array(padded, dtype=input_ids.dtype)], axis=1
+            )
+
+        generated = [[] for _ in input_ids]
+        decode_time = 0.0
+        with self._lock:
+            for i, (ids, mask) in enumerate(zip(input_ids, attention_mask)):
+                prompt = ids[mask.astype(bool)].tolist()
+                time_start = None
+                for token in self.llm.generate(
+                    prompt,
+                    temp=temperature,
+                    repeat_penalty=repetition_penalty,
+                    min_p=min_p,
+                ):
+                    if time_start is None:
+                        time_start = time.time()  # The prompt is evaluated.
+                    if self.is_end(token):
+                        break
+                    generated[i].append(token)
+                    if len(generated[i]) >= max_new_tokens or any(
+                        bool(criterion(sequences(), None)[i])
+                        for criterion in stopping_criteria
+                    ):
+                        break
+                if time_start is not None:
+                    decode_time += time.time() - time_start
+        num_tokens = sum(len(ids) for ids in generated)
+        if decode_time:
+            print(
+                f"llama.cpp decoded {num_tokens} tokens at"
+                f" {num_tokens / decode_time:.1f} tokens/s."
+            )
+        return sequences()
+
+
+def load_cpu_model(model_path=GGUF_MODEL, n_threads=CPU_THREADS, n_ctx=2048):
+    """
+    Loads the GGUF model at `model_path` with llama.cpp, running on `n_threads` CPU
+    threads, and returns a (model, tokenizer) pair, like `inference_local.load_model`.
+    """
+    from llama_cpp import Llama
+
+    if not model_path:
+        raise ValueError(
+            "Set CLAIM_CHECKER_GGUF_MODEL to the GGUF file of the model to run it on"
+            " the CPU."
+        )
+    print(f"Loading model {model_path} on {n_threads} CPU threads...")
+    time_start = time.time()
+    llm = Llama(
+        model_path=model_path,
+        n_ctx=n_ctx,
+        n_threads=n_threads,
+        n_threads_batch=n_threads,
+        verbose=False,
+    )
+    print(f"model loaded in {time.time() - time_start} s")
+    return LlamaCppModel(llm), LlamaCppTokenizer(llm)
@@ -1,3 +1,28 @@
+import copy
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, as_completed
+
+from tracing import span
+from wire import INTERACTIVE, ContentStore, serve_payload
+
+
+MAX_BATCH_SIZE = 8
+MAX_SEQ_LENGTH = 2048
+MAX_NEW_TOKENS = 256
+TRUNCATION = "relevance"  # How long articles are shortened: "relevance" or "head_tail".
+MAX_CHUNKS = 4  # Maximum number of chunks per article when chunking is enabled.
+CHUNK_SEPARATOR = "\n\n<<< next chunk >>>\n\n"  # Same as in response_handler.
+SAMPLING = {"temperature": 1.2, "repetition_penalty": 1.1, "min_p": 0.1}
+STOP_AT_TABLE = True  # Stop generating as soon as the stance table is complete.
+PREFIX_CACHE = True  # Reuse the KV cache of the instructions and claim prefix.
+CONTINUOUS_BATCHING = True  # Batch the prompts of concurrent requests together.
+MAX_BATCH_WAIT = 0.05  # Seconds a prompt waits for a fuller batch.
+
+
 def inference_prompt(claim, article):
     return f"""You are an impartial evaluator tasked with determining the relationship between a given claim and an article's content. Your job is to analyze the text of the article and assess whether it **agrees**, **disagrees**, is **unrelated**, or if there was an **error** in processing the input. Additionally, provide a single overall comment summarizing your reasoning first, followed by a probability score (0%-100%) for each label.
 
@@ -39,11 +64,21 @@ If the "An error occurred" label has a probability higher than 5%, it indicates
 """
 
 
+# Engine running the model: "unsloth" (4-bit, needs a CUDA GPU) or "llama_cpp" (a
+# GGUF export of the model on the CPU, see inference_cpu.py).
+BACKEND = os.environ.get("CLAIM_CHECKER_BACKEND", "unsloth")
+
+
 def load_model():
+    if BACKEND == "llama_cpp":
+        from inference_cpu import load_cpu_model
+
+        return load_cpu_model(n_ctx=MAX_SEQ_LENGTH)
+
     from unsloth import FastLanguageModel
     import time
 
-    max_seq_length = 2048
+    max_seq_length = MAX_SEQ_LENGTH
     dtype = None
     model_name_or_path = "Eugenius0/lora_model_tuned"
 
@@ -60,9 +95,108 @@ def load_model():
     return model, tokenizer
 
 
-def infer_stance(claim, article, model_tokenizer=None):
+def add_usage(stats, **counts):
+    """
+    Accumulates token counts (prompt_tokens, generated_tokens, ...) and timings in
+    the `stats` dict, if one is given.
+    """
+    if stats is not None:
+        for key, value in counts.items():
+            stats[key] = stats.get(key, 0) + value
+
+
+def supports_prefix_cache(model):
+    """
+    Whether the model can extend the KV caches of a `PrefixCache`. Models reusing
+    the prompt prefixes by themselves (llama.cpp) set `supports_prefix_cache` false.
+    """
+    return getattr(model, "supports_prefix_cache", True)
+
+
+def model_device(model):
+    """Returns the device of the model, the CPU for llama.cpp."""
+    return getattr(model, "device", "cpu")
+
+
+def bool_tensor(values, like):
+    """
+    Returns the booleans `values` as a tensor of the kind of `like`: a torch tensor
+    on its device, or a NumPy array for llama.cpp, which doesn't use torch.
+    """
+    if type(like).__module__ == "numpy":
+        import numpy
+
+        return numpy.array(values, dtype=bool)
+    import torch
+
+    return torch.tensor(values, dtype=torch.bool, device=like.device)
+
+
+class StanceTableComplete:
+    """
+    Stopping criterion for `model.generate` (a transformers `StoppingCriteria`)
+    telling which sequences hold a complete response: the overall comment and the
+    four rows of the stance table, which is all that `parse_result` reads. Whatever
+    the model would write next is not generated.
+    """
+
+    patterns = [re.compile(r"Overall Comment:\**\s+\S", re.IGNORECASE)] + [
+        re.compile(rf"\|\s*{label}\s*\|[^|\n]*\|", re.IGNORECASE)
+        for label in ["Agrees", "Disagrees", "Unrelated", "An error occurred"]
+    ]
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stopped = 0  # Number of sequences stopped by the criterion.
+        self._done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self._done is None:
+            self._done = [False] * len(input_ids)
+        for i, ids in enumerate(input_ids):
+            if self._done[i]:
+                continue
+            text = self.tokenizer.decode(
+                ids[self.prompt_length :], skip_special_tokens=True
+            )
+            if all(pattern.search(text) for pattern in self.patterns):
+                self._done[i] = True
+                self.stopped += 1
+        return bool_tensor(self._done, input_ids)
+
+
+def stopping_criteria(tokenizer, prompt_length):
+    """
+    Returns the stopping criteria of a generation whose prompts are `prompt_length`
+    tokens long (padding included), as a list (which `generate` accepts in place of
+    a `StoppingCriteriaList`), and the `StanceTableComplete` criterion if
+    STOP_AT_TABLE is set (else None).
+    """
+    if not STOP_AT_TABLE:
+        return [], None
+    criterion = StanceTableComplete(tokenizer, prompt_length)
+    return [criterion], criterion
+
+
+class PrefillTimer:
+    """
+    Stopping criterion that never stops the generation, but records how long the
+    prompts took to prefill, i.e. until the first token was generated.
+    """
+
+    def __init__(self):
+        self.time_start = time.time()
+        self.prefill_time = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prefill_time is None:
+            self.prefill_time = time.time() - self.time_start
+        return bool_tensor([False] * len(input_ids), input_ids)
+
+
+def infer_stance(claim, article, model_tokenizer=None, stats=None):
     try:
-        import torch
         import time
 
         if model_tokenizer == None:
@@ -70,10 +204,10 @@ def infer_stance(claim, article, model_tokenizer=None):
         else:
             model, tokenizer = model_tokenizer
 
-        title = article["title"]
-        publisher = article["publisher"]
+        title = article.get("title", "(untitled)")
+        publisher = article.get("publisher", "unknown publisher")
 
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        device = model_device(model)
 
         prompt = inference_prompt(claim, article)
         messages = [
@@ -87,29 +221,841 @@ def infer_stance(claim, article, model_tokenizer=None):
             tokenize=True,
             add_generation_prompt=True,
             return_tensors="pt",
-        ).to(device)
+        )
+        if device != "cpu":
+            inputs = inputs.to(device)
 
         # Generate response
         print(f"Analyzing article {title} from {publisher}...")
         time_start = time.time()
+        criteria, criterion = stopping_criteria(tokenizer, inputs.shape[-1])
+        timer = PrefillTimer()
+        criteria.append(timer)
         outputs = model.generate(
             input_ids=inputs,
-            max_new_tokens=256,
+            max_new_tokens=MAX_NEW_TOKENS,
             use_cache=True,
-            temperature=1.2,
-            repetition_penalty=1.1,
-            min_p=0.1,
+            **SAMPLING,
+            stopping_criteria=criteria,
         )
         print(f"Done in {time.time() - time_start}.")
+        add_usage(
+            stats,
+            prompt_tokens=inputs.shape[-1],
+            generated_tokens=outputs.shape[-1] - inputs.shape[-1],
+            stopped_early=criterion.stopped if criterion else 0,
+            prefill_time=timer.prefill_time or 0,
+        )
         time_start = time.time()
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-        if len(response) > len(prompt):
-            return response[len(prompt) :]
-        return response
+        return tokenizer.decode(
+            outputs[0, inputs.shape[-1] :], skip_special_tokens=True
+        ).strip()
     except Exception as e:
         return f"Error while inferring stance: {e}"
 
 
-def batch_infer_stances(claim, articles):
-    model_tokenizer = load_model()
-    return [infer_stance(claim, article, model_tokenizer) for article in articles]
+def chat_prompt(claim, article, tokenizer):
+    messages = [
+        {
+            "role": "user",
+            "content": inference_prompt(claim, article),
+        }
+    ]
+    return tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True,
+    )
+
+
+def prompt_prefix(claim, tokenizer):
+    """
+    Returns the beginning of the chat prompts of the claim's articles, up to the
+    article content. If `claim` is None, returns the part before the claim, which
+    is shared by all the claims.
+    """
+    marker = "\x00"
+    if claim is None:
+        prompt = chat_prompt(marker, {"content": ""}, tokenizer)
+    else:
+        prompt = chat_prompt(claim, {"content": marker}, tokenizer)
+    return prompt[: prompt.index(marker)]
+
+
+class PrefixCache:
+    """
+    KV caches of the prompt prefixes shared by the articles, so that they are only
+    prefilled once: the instructions, computed once and kept for the whole process,
+    and the instructions followed by a claim, extended from the former once per
+    claim. The caches of the last `max_claims` claims are kept.
+    """
+
+    def __init__(self, max_claims=8):
+        self.max_claims = max_claims
+        self.enabled = True  # Turned off if the model fails to use the caches.
+        self._instructions = None  # (prefix, token ids, KV cache)
+        self._claims = OrderedDict()  # prefix -> (token ids, KV cache)
+        self._lock = threading.Lock()
+
+    def get(self, prefix, model_tokenizer, stats=None):
+        """
+        Returns the token ids of the prompt prefix and a copy of its KV cache, which
+        the generation can extend. The prefix must start with the instructions, see
+        `prompt_prefix`. The time spent computing caches is added to `stats`.
+        """
+        _, tokenizer = model_tokenizer
+        with self._lock:
+            if self._instructions is None:
+                instructions = prompt_prefix(None, tokenizer)
+                ids = tokenizer(instructions, add_special_tokens=False)["input_ids"]
+                cache = self._extend(None, ids, model_tokenizer, stats)
+                self._instructions = (instructions, ids, cache)
+            instructions, instructions_ids, instructions_cache = self._instructions
+            if prefix == instructions:
+                return instructions_ids, copy.deepcopy(instructions_cache)
+
+            if prefix not in self._claims:
+                # The prefix is tokenized whole, its first tokens are only those of
+                # the instructions if the claim didn't merge with their end.
+                ids = tokenizer(prefix, add_special_tokens=False)["input_ids"]
+                length = len(instructions_ids)
+                if ids[:length] == instructions_ids:
+                    cache = self._extend(
+                        instructions_cache, ids[length:], model_tokenizer, stats
+                    )
+                else:
+                    cache = self._extend(None, ids, model_tokenizer, stats)
+                self._claims[prefix] = (ids, cache)
+                while len(self._claims) > self.max_claims:
+                    self._claims.popitem(last=False)
+            self._claims.move_to_end(prefix)
+            ids, cache = self._claims[prefix]
+            return ids, copy.deepcopy(cache)
+
+    def _extend(self, cache, new_ids, model_tokenizer, stats):
+        """Returns a copy of the KV `cache` (None if empty) extended with `new_ids`."""
+        import torch
+        from transformers import DynamicCache
+
+        model, _ = model_tokenizer
+        time_start = time.time()
+        cache = copy.deepcopy(cache) if cache is not None else DynamicCache()
+        with torch.no_grad():
+            model(
+                input_ids=torch.tensor([new_ids], device=model_device(model)),
+                past_key_values=cache,
+                use_cache=True,
+            )
+        add_usage(stats, prefix_time=time.time() - time_start)
+        return cache
+
+
+def count_tokens(text, tokenizer):
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+
+def article_token_budget(claim, tokenizer):
+    """
+    Number of article tokens that fit in the context window, once the instructions,
+    the claim and the generated response are accounted for.
+    """
+    overhead = count_tokens(chat_prompt(claim, {"content": ""}, tokenizer), tokenizer)
+    budget = MAX_SEQ_LENGTH - MAX_NEW_TOKENS - overhead
+    if budget <= 0:
+        raise ValueError("The prompt leaves no room for the article in the context.")
+    return budget
+
+
+def split_passages(text):
+    return [passage.strip() for passage in text.split("\n") if passage.strip()]
+
+
+def truncate_head_tail(text, budget, tokenizer, head_ratio=0.7):
+    """
+    Keeps the beginning and the end of the text, where articles usually state their
+    point, and drops the middle so that the result fits in `budget` tokens.
+    """
+    token_ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    if len(token_ids) <= budget:
+        return text
+    marker = "\n[...]\n"
+    budget = max(budget - count_tokens(marker, tokenizer), 0)
+    head = int(budget * head_ratio)
+    tail = budget - head
+    return (
+        tokenizer.decode(token_ids[:head])
+        + marker
+        + tokenizer.decode(token_ids[len(token_ids) - tail :])
+    )
+
+
+def select_passages(claim, text, budget, tokenizer):
+    """
+    Keeps the passages that share the most words with the claim, in their original
+    order, as long as they fit in `budget` tokens.
+    """
+    claim_terms = {word for word in claim.lower().split() if len(word) > 3}
+    passages = split_passages(text)
+    scores = [len(claim_terms & set(passage.lower().split())) for passage in passages]
+    ranking = sorted(range(len(passages)), key=lambda i: (-scores[i], i))
+
+    selected = []
+    used = 0
+    for i in ranking:
+        length = count_tokens(passages[i], tokenizer) + 1  # +1 for the line break.
+        if used + length <= budget:
+            selected.append(i)
+            used += length
+    if not selected:  # Even the best passage is too long.
+        return truncate_head_tail(text, budget, tokenizer)
+    return "\n".join(passages[i] for i in sorted(selected))
+
+
+def fit_article(claim, article, budget, tokenizer, truncation=TRUNCATION):
+    """Returns a copy of the article whose content fits in `budget` tokens."""
+    content = article["content"]
+    if count_tokens(content, tokenizer) <= budget:
+        return article
+    if truncation == "head_tail":
+        content = truncate_head_tail(content, budget, tokenizer)
+    else:
+        content = select_passages(claim, content, budget, tokenizer)
+    return {**article, "content": content}
+
+
+def chunk_article(article, budget, tokenizer, max_chunks=MAX_CHUNKS):
+    """
+    Splits the article into at most `max_chunks` consecutive chunks of whole
+    passages, each fitting in `budget` tokens. Text beyond the last chunk is dropped.
+    """
+    chunks = []
+    current = []
+    used = 0
+    for passage in split_passages(article["content"]):
+        length = count_tokens(passage, tokenizer) + 1
+        if length > budget:
+            passage = truncate_head_tail(passage, budget - 1, tokenizer)
+            length = budget
+        if current and used + length > budget:
+            chunks.append("\n".join(current))
+            current, used = [], 0
+        current.append(passage)
+        used += length
+    if current:
+        chunks.append("\n".join(current))
+    return [{**article, "content": chunk} for chunk in chunks[:max_chunks]] or [article]
+
+
+def generate_batch(prompts, model_tokenizer, stats=None, prefix="", prefix_cache=None):
+    """
+    Runs a single `generate` over a left-padded batch of chat prompts and returns
+    the decoded generated text of each prompt, in order. Token counts and the
+    prefill time are added to `stats` if given.
+
+    If a `prefix_cache` is given, the `prefix` shared by all the prompts is not
+    prefilled again: its cached keys and values are reused, and the prompts are
+    padded between the prefix and their rest instead of on the left. The prompts are
+    tokenized whole and split after the tokens of the prefix, so that the model gets
+    the same tokens as without the cache. If the end of the prefix merges into
+    another token in a prompt, the batch is generated without the cache.
+    """
+    model, tokenizer = model_tokenizer
+    device = model_device(model)
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    if (
+        prefix
+        and prefix_cache is not None
+        and prefix_cache.enabled
+        and supports_prefix_cache(model)
+    ):
+        import torch
+
+        try:
+            prefix_ids, past_key_values = prefix_cache.get(
+                prefix, model_tokenizer, stats
+            )
+            ids = [
+                tokenizer(prompt, add_special_tokens=False)["input_ids"]
+                for prompt in prompts
+            ]
+            if all(item[: len(prefix_ids)] == prefix_ids for item in ids):
+                past_key_values.batch_repeat_interleave(len(prompts))
+                rests = [item[len(prefix_ids) :] for item in ids]
+                length = max(len(rest) for rest in rests)
+                padding = [length - len(rest) for rest in rests]
+                input_ids = [
+                    prefix_ids + [tokenizer.pad_token_id] * pad + rest
+                    for pad, rest in zip(padding, rests)
+                ]
+                attention_mask = [
+                    [1] * len(prefix_ids) + [0] * pad + [1] * len(rest)
+                    for pad, rest in zip(padding, rests)
+                ]
+                inputs = {
+                    "input_ids": torch.tensor(input_ids, device=device),
+                    "attention_mask": torch.tensor(attention_mask, device=device),
+                    "past_key_values": past_key_values,
+                }
+                cached_tokens = len(prefix_ids) * len(prompts)
+                return generate_from_inputs(
+                    inputs, model_tokenizer, stats, cached_tokens
+                )
+        except Exception as e:
+            print(f"Prefix caching failed ({e}), disabling it.")
+            prefix_cache.enabled = False
+
+    tokenizer.padding_side = "left"  # Generation continues from the right end.
+    inputs = tokenizer(
+        prompts,
+        return_tensors="pt",
+        padding=True,
+        add_special_tokens=False,  # The chat template already added them.
+    ).to(device)
+    return generate_from_inputs(inputs, model_tokenizer, stats)
+
+
+def generate_from_inputs(inputs, model_tokenizer, stats=None, cached_tokens=0):
+    """
+    Generates the responses to the tokenized prompts of `inputs` and returns their
+    decoded text. `cached_tokens` prompt tokens come from a prefix cache.
+    """
+    model, tokenizer = model_tokenizer
+    prompt_length = inputs["input_ids"].shape[1]
+    criteria, criterion = stopping_criteria(tokenizer, prompt_length)
+    timer = PrefillTimer()
+    criteria.append(timer)
+    outputs = model.generate(
+        **inputs,
+        max_new_tokens=MAX_NEW_TOKENS,
+        use_cache=True,
+        **SAMPLING,
+        pad_token_id=tokenizer.pad_token_id,
+        stopping_criteria=criteria,
+    )
+    generated = outputs[:, prompt_length:]
+    add_usage(
+        stats,
+        prompt_tokens=int(inputs["attention_mask"].sum()),
+        cached_prompt_tokens=cached_tokens,
+        generated_tokens=int((generated != tokenizer.pad_token_id).sum()),
+        stopped_early=criterion.stopped if criterion else 0,
+        prefill_time=timer.prefill_time or 0,
+    )
+    return [
+        response.strip()
+        for response in tokenizer.batch_decode(generated, skip_special_tokens=True)
+    ]
+
+
+def infer_batch(batch, model_tokenizer, stats=None, prefix_cache=None):
+    """
+    Generates the responses to a batch of (claim, article, chat prompt) triples with
+    a single `generate_batch`. If the batch fails, its prompts are inferred one at a
+    time with `infer_stance` so that a single bad article only affects its own
+    result.
+
+    Returns:
+        list: The raw model response to each prompt, in order.
+    """
+    _, tokenizer = model_tokenizer
+    print(f"Analyzing a batch of {len(batch)} articles...")
+    time_start = time.time()
+    prefix = ""
+    if prefix_cache is not None:
+        claims = {claim for claim, _, _ in batch}
+        claim = claims.pop() if len(claims) == 1 else None
+        prefix = prompt_prefix(claim, tokenizer)
+    try:
+        responses = generate_batch(
+            [prompt for _, _, prompt in batch],
+            model_tokenizer,
+            stats,
+            prefix=prefix,
+            prefix_cache=prefix_cache,
+        )
+    except Exception as e:
+        print(f"Batch failed ({e}), analyzing its articles one by one.")
+        responses = [
+            infer_stance(claim, article, model_tokenizer, stats)
+            for claim, article, _ in batch
+        ]
+    print(f"Done in {time.time() - time_start}.")
+    return responses
+
+
+def iter_infer_pairs(
+    pairs,
+    model_tokenizer,
+    max_batch_size=MAX_BATCH_SIZE,
+    truncation=TRUNCATION,
+    chunking=False,
+    stats=None,
+    prefix_cache=None,
+    scheduler=None,
+    priority=INTERACTIVE,
+):
+    """
+    Infers the stance of every (claim, article) pair with batched generation,
+    yielding each result as soon as it is available. The pairs may belong to
+    different claims, so that the articles of several claims share the batches.
+
+    Each article is first fitted into the token budget left by the prompt, either
+    shortened with `truncation` or, if `chunking` is set, split into several chunks
+    that are all analyzed. Prompts are then sorted by token length and split into
+    batches of at most `max_batch_size` prompts, so that each batch holds prompts of
+    similar length and wastes little compute on padding, see `infer_batch`. Token
+    counts are added to `stats` if given. With a `prefix_cache`, the instructions
+    and the claim (if all the prompts of a batch share it) are not prefilled for
+    every batch, see `PrefixCache`. With a `scheduler`, the prompts are instead
+    queued with `priority` in the `BatchScheduler` shared by the concurrent
+    requests, whose batch size and prefix cache apply.
+
+    Yields:
+        tuple: The index of the pair in `pairs` and its raw model response. The
+        responses for the chunks of an article are joined with CHUNK_SEPARATOR.
+    """
+    _, tokenizer = model_tokenizer
+
+    budgets = {}  # claim -> article token budget
+    pieces = []  # (pair index, claim, article or chunk of article)
+    for i, (claim, article) in enumerate(pairs):
+        try:
+            if claim not in budgets:
+                budgets[claim] = article_token_budget(claim, tokenizer)
+            budget = budgets[claim]
+            if chunking:
+                pieces += [
+                    (i, claim, chunk)
+                    for chunk in chunk_article(article, budget, tokenizer)
+                ]
+            else:
+                article = fit_article(claim, article, budget, tokenizer, truncation)
+                pieces.append((i, claim, article))
+        except Exception as e:
+            yield i, f"Error while inferring stance: {e}"
+
+    responses = [None] * len(pieces)
+    remaining = {}  # pair index -> number of pieces without a response
+    for i, _, _ in pieces:
+        remaining[i] = remaining.get(i, 0) + 1
+
+    def complete(j, response):
+        responses[j] = response
+        i = pieces[j][0]
+        remaining[i] -= 1
+        if remaining[i] == 0:
+            return i, CHUNK_SEPARATOR.join(
+                responses[k] for k, (index, _, _) in enumerate(pieces) if index == i
+            )
+
+    prompts = {}
+    lengths = {}
+    for j, (_, claim, piece) in enumerate(pieces):
+        try:
+            prompts[j] = chat_prompt(claim, piece, tokenizer)
+            lengths[j] = count_tokens(prompts[j], tokenizer)
+        except Exception as e:
+            result = complete(j, f"Error while inferring stance: {e}")
+            if result:
+                yield result
+
+    if scheduler is not None:
+        futures = {
+            scheduler.submit(
+                pieces[j][1], pieces[j][2], prompts[j], lengths[j], priority, stats
+            ): j
+            for j in prompts
+        }
+        try:
+            for future in as_completed(futures):
+                result = complete(futures[future], future.result())
+                if result:
+                    yield result
+        finally:
+            # The prompts of an abandoned request are dropped from the queue.
+            for future in futures:
+                future.cancel()
+        return
+
+    order = sorted(prompts, key=lambda j: lengths[j])
+    for start in range(0, len(order), max_batch_size):
+        batch = order[start : start + max_batch_size]
+        batch_responses = infer_batch(
+            [(pieces[j][1], pieces[j][2], prompts[j]) for j in batch],
+            model_tokenizer,
+            stats,
+            prefix_cache,
+        )
+        for j, response in zip(batch, batch_responses):
+            result = complete(j, response)
+            if result:
+                yield result
+
+
+def iter_infer_stances(claim, articles, model_tokenizer, **kwargs):
+    """
+    Infers the stance of every article about the claim, see `iter_infer_pairs`.
+
+    Yields:
+        tuple: The index of the article in `articles` and its raw model response.
+    """
+    yield from iter_infer_pairs(
+        [(claim, article) for article in articles], model_tokenizer, **kwargs
+    )
+
+
+def infer_stances(claim, articles, model_tokenizer, **kwargs):
+    """
+    Infers the stance of every article, see `iter_infer_stances`.
+
+    Returns:
+        list: The raw model response for each article, in the order of `articles`.
+    """
+    results = [None] * len(articles)
+    for i, result in iter_infer_stances(claim, articles, model_tokenizer, **kwargs):
+        results[i] = result
+    return results
+
+
+class BatchScheduler:
+    """
+    Continuous batching of the prompts of all the requests served at once, so that
+    concurrent claims fill the same GPU batches instead of each running its own
+    small batches one after the other.
+
+    The requests queue their prompts and get a future for each of them. A single
+    thread runs the model: as soon as it is free, it waits until `max_batch_size`
+    prompts are queued or the oldest one has waited `max_wait` seconds, then batches
+    the queued prompt of highest priority (the oldest one among equals) with the
+    prompts of the same priority queued within `max_wait` after it, those closest
+    to it in token length first, and fills the rest of the batch with the next
+    prompts closest in length. The batches are thus as full as the load allows and
+    hold prompts of similar lengths, the requests are served in the order they
+    arrived, and a bulk job only takes the places left by the interactive requests.
+    The responses, and the token counts shared by the prompts of a batch, are
+    handed back through the futures.
+
+    Parameters:
+    - model_tokenizer: The model and its tokenizer, see `load_model`.
+    - max_batch_size: Maximum number of prompts per batch.
+    - max_wait: Maximum number of seconds a prompt waits for a fuller batch.
+    - prefix_cache: `PrefixCache` of the model, if any.
+    """
+
+    def __init__(
+        self,
+        model_tokenizer,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait=MAX_BATCH_WAIT,
+        prefix_cache=None,
+    ):
+        self.model_tokenizer = model_tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.prefix_cache = prefix_cache
+        self._queue = []  # Queued prompts, see `submit`.
+        self._totals = {
+            "batches": 0,
+            "prompts": 0,
+            "queue_depth": 0,
+            "prompt_tokens": 0,
+            "padded_tokens": 0,
+            "wait": 0.0,
+        }
+        self._max_wait = 0.0
+        self._waits = {}  # priority -> (number of prompts, total wait)
+        self._condition = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, claim, article, prompt, length, priority=INTERACTIVE, stats=None):
+        """
+        Queues the chat prompt (`length` tokens long) of the article about the
+        claim, and returns the future of its raw model response. The prompts of
+        lower `priority` are served first, see INTERACTIVE and BULK. The share of
+        the prompt in the token counts of its batch is added to `stats`.
+        """
+        future = Future()
+        with self._condition:
+            self._queue.append(
+                {
+                    "claim": claim,
+                    "article": article,
+                    "prompt": prompt,
+                    "length": length,
+                    "priority": priority,
+                    "stats": stats,
+                    "future": future,
+                    "queued_at": time.monotonic(),
+                }
+            )
+            self._condition.notify()
+        return future
+
+    def _next_batch(self):
+        """Waits for the next batch, returns it and the number of queued prompts."""
+        with self._condition:
+            while True:
+                self._queue = [
+                    item for item in self._queue if not item["future"].cancelled()
+                ]
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                oldest = min(item["queued_at"] for item in self._queue)
+                remaining = oldest + self.max_wait - time.monotonic()
+                if len(self._queue) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            first = min(
+                self._queue, key=lambda item: (item["priority"], item["queued_at"])
+            )
+            batch = sorted(
+                self._queue,
+                key=lambda item: (
+                    item["priority"],
+                    item["queued_at"] - first["queued_at"] > self.max_wait,
+                    abs(item["length"] - first["length"]),
+                    item["queued_at"],
+                ),
+            )[: self.max_batch_size]
+            queue_depth = len(self._queue)
+            batched = {id(item) for item in batch}
+            self._queue = [item for item in self._queue if id(item) not in batched]
+        batch = [
+            item for item in batch if item["future"].set_running_or_notify_cancel()
+        ]
+        return batch, queue_depth
+
+    def _record(self, batch, queue_depth, time_start):
+        waits = [time_start - item["queued_at"] for item in batch]
+        lengths = [item["length"] for item in batch]
+        with self._condition:
+            for key, value in [
+                ("batches", 1),
+                ("prompts", len(batch)),
+                ("queue_depth", queue_depth),
+                ("prompt_tokens", sum(lengths)),
+                ("padded_tokens", max(lengths) * len(batch)),
+                ("wait", sum(waits)),
+            ]:
+                self._totals[key] += value
+            self._max_wait = max(self._max_wait, *waits)
+            for item, wait in zip(batch, waits):
+                count, total = self._waits.get(item["priority"], (0, 0.0))
+                self._waits[item["priority"]] = (count + 1, total + wait)
+        print(
+            f"Batched {len(batch)} of {queue_depth} queued prompts from"
+            f" {len({item['claim'] for item in batch})} claims, after waiting up to"
+            f" {max(waits):.3f} s."
+        )
+
+    def _run(self):
+        while True:
+            batch, queue_depth = self._next_batch()
+            if not batch:
+                continue
+            self._record(batch, queue_depth, time.monotonic())
+            stats = {}
+            try:
+                responses = infer_batch(
+                    [
+                        (item["claim"], item["article"], item["prompt"])
+                        for item in batch
+                    ],
+                    self.model_tokenizer,
+                    stats,
+                    self.prefix_cache,
+                )
+            except Exception as e:
+                for item in batch:
+                    item["future"].set_exception(e)
+                continue
+            shares = {key: value / len(batch) for key, value in stats.items()}
+            for item, response in zip(batch, responses):
+                add_usage(item["stats"], **shares)
+                item["future"].set_result(response)
+
+    def metrics(self):
+        """
+        Returns the number of queued prompts, and for the batches so far, the mean
+        number of queued prompts when a batch is formed, the mean batch fill ratio
+        (prompts over `max_batch_size`), the share of padding tokens, and the mean
+        and maximum wait of the prompts in seconds (overall and per priority).
+        """
+        with self._condition:
+            totals = self._totals
+            batches, prompts = totals["batches"], totals["prompts"]
+            if not batches:
+                return {"queue_depth": len(self._queue), "batches": 0}
+            return {
+                "queue_depth": len(self._queue),
+                "batches": batches,
+                "mean_queue_depth": totals["queue_depth"] / batches,
+                "batch_fill_ratio": prompts / (batches * self.max_batch_size),
+                "padding_ratio": 1 - totals["prompt_tokens"] / totals["padded_tokens"],
+                "mean_wait": totals["wait"] / prompts,
+                "max_wait": self._max_wait,
+                "mean_wait_by_priority": {
+                    priority: total / count
+                    for priority, (count, total) in sorted(self._waits.items())
+                },
+            }
+
+
+class StanceModel:
+    """
+    Process-resident stance inference server.
+
+    The model is loaded once per process, on the first request (or explicitly with
+    `load`), and kept warm in memory for all the following requests. The latency of
+    the first (cold) request and of the following (warm) ones are reported separately.
+    With `continuous_batching`, the prompts of the requests running at once share
+    the same batches, see `BatchScheduler`.
+    """
+
+    def __init__(
+        self,
+        max_batch_size=MAX_BATCH_SIZE,
+        truncation=TRUNCATION,
+        chunking=False,
+        continuous_batching=CONTINUOUS_BATCHING,
+    ):
+        self.max_batch_size = max_batch_size
+        self.truncation = truncation
+        self.chunking = chunking
+        self.continuous_batching = continuous_batching
+        self.scheduler = None
+        self.prefix_cache = None  # Created on load, if the model supports it.
+        self.content_store = ContentStore()
+        self.model_tokenizer = None
+        self.load_time = None
+        self.cold_latency = None
+        self.warm_latencies = []
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        with self._load_lock:
+            if self.model_tokenizer is None:
+                time_start = time.time()
+                with span("load_model"):
+                    model_tokenizer = load_model()
+                if PREFIX_CACHE and supports_prefix_cache(model_tokenizer[0]):
+                    self.prefix_cache = PrefixCache()
+                if self.continuous_batching:
+                    self.scheduler = BatchScheduler(
+                        model_tokenizer,
+                        self.max_batch_size,
+                        prefix_cache=self.prefix_cache,
+                    )
+                self.model_tokenizer = model_tokenizer
+                self.load_time = time.time() - time_start
+        return self.model_tokenizer
+
+    def batch_infer_stances(self, claim, articles, priority=INTERACTIVE):
+        return [
+            result
+            for _, result in sorted(
+                self.stream_infer_stances(claim, articles, priority)
+            )
+        ]
+
+    def stream_infer_stances(self, claim, articles, priority=INTERACTIVE):
+        """Yields (article index, raw result) pairs as the results are produced."""
+        yield from self._stream(
+            "batch_infer_stances", [(claim, article) for article in articles], priority
+        )
+
+    def batch_infer_pairs(self, pairs, priority=INTERACTIVE):
+        """
+        Returns the raw result of every (claim, article) pair, in order. The
+        articles of all the claims share the same batches.
+        """
+        results = self._stream("batch_infer_pairs", pairs, priority)
+        return [result for _, result in sorted(results)]
+
+    def stream_payload(self, payload):
+        """
+        Yields the encoded results of a request encoded with `encode_request`, see
+        `serve_payload`.
+        """
+        yield from serve_payload(
+            payload,
+            self.content_store,
+            lambda pairs, priority: self._stream("stream_payload", pairs, priority),
+        )
+
+    def _stream(self, name, pairs, priority=INTERACTIVE):
+        with span(name, articles=len(pairs), priority=priority) as inference_span:
+            cold = self.model_tokenizer is None
+            time_start = time.time()
+            model_tokenizer = self.load()
+            stats = {}
+            yield from iter_infer_pairs(
+                pairs,
+                model_tokenizer,
+                max_batch_size=self.max_batch_size,
+                truncation=self.truncation,
+                chunking=self.chunking,
+                stats=stats,
+                prefix_cache=self.prefix_cache,
+                scheduler=self.scheduler,
+                priority=priority,
+            )
+            latency = time.time() - time_start
+            tokens_per_second = stats.get("generated_tokens", 0) / latency
+            inference_span.set(cold=cold, tokens_per_second=tokens_per_second, **stats)
+            if pairs:
+                print(
+                    f"Generated {stats.get('generated_tokens', 0):.0f} tokens"
+                    f" ({tokens_per_second:.1f} tokens/s)."
+                )
+                prefill_time = stats.get("prefill_time", 0) / len(pairs)
+                print(
+                    f"Prefill: {prefill_time:.3f} s per article,"
+                    f" {stats.get('cached_prompt_tokens', 0):.0f} of"
+                    f" {stats.get('prompt_tokens', 0):.0f} prompt tokens from the"
+                    " prefix cache."
+                )
+            if cold:
+                self.cold_latency = latency
+                print(
+                    f"Cold request: {len(pairs)} stances in {latency:.2f} s"
+                    f" (model loaded in {self.load_time:.2f} s)."
+                )
+            else:
+                self.warm_latencies.append(latency)
+                print(f"Warm request: {len(pairs)} stances in {latency:.2f} s.")
+
+    def stats(self):
+        return {
+            "load_time": self.load_time,
+            "cold_latency": self.cold_latency,
+            "warm_requests": len(self.warm_latencies),
+            "warm_latency_mean": (
+                sum(self.warm_latencies) / len(self.warm_latencies)
+                if self.warm_latencies
+                else None
+            ),
+            "scheduler": self.scheduler.metrics() if self.scheduler else None,
+        }
+
+
+stance_model = StanceModel()
+
+
+def batch_infer_stances(claim, articles, priority=INTERACTIVE):
+    return stance_model.batch_infer_stances(claim, articles, priority)
+
+
+def stream_infer_stances(claim, articles, priority=INTERACTIVE):
+    return stance_model.stream_infer_stances(claim, articles, priority)
+
+
+def batch_infer_pairs(pairs, priority=INTERACTIVE):
+    return stance_model.batch_infer_pairs(pairs, priority)
+
+
+def stream_payload(payload):
+    return stance_model.stream_payload(payload)
@@ -1,130 +1,141 @@
 import modal
+import time
+
+import tracing
+from inference_local import (
+    CONTINUOUS_BATCHING,
+    PREFIX_CACHE,
+    BatchScheduler,
+    PrefixCache,
+    iter_infer_pairs,
+    load_model,
+)
+from wire import INTERACTIVE, ContentStore, serve_payload
 
 app = modal.App(name="claim-checker")
 gpu = "a10g"
-
-claim_checker_image = modal.Image.debian_slim(python_version="3.10").pip_install(
-    "unsloth", "bitsandbytes", "torch"
+MAX_CONTAINERS = 4  # GPU containers the shards of a claim can fan out to.
+MAX_INPUTS = 8  # Requests a container serves at once, batching their prompts.
+
+# The inference code is shared with the local backend, so that both run the same
+# prompts and settings (which the stance cache is keyed on).
+claim_checker_image = (
+    modal.Image.debian_slim(python_version="3.10")
+    .pip_install("unsloth", "bitsandbytes", "torch", "zstandard")
+    .add_local_python_source("inference_local", "wire", "tracing")
 )
 
 
-def inference_prompt(claim, article):
-    return f"""You are an impartial evaluator tasked with determining the relationship between a given claim and an article's content. Your job is to analyze the text of the article and assess whether it **agrees**, **disagrees**, is **unrelated**, or if there was an **error** in processing the input. Additionally, provide a single overall comment summarizing your reasoning first, followed by a probability score (0%-100%) for each label.
-
-If the "An error occurred" label has a probability higher than 5%, it indicates a significant pipeline issue. Set the probabilities for other labels to 0% in this case, and reflect this issue in your overall comment.
-
-### Instructions:
-1. Carefully read the claim and the article.
-2. Write a **single overall comment** in 10 to 20 words summarizing your evaluation. Include:
-   - Key points from the article and their relationship to the claim.
-   - A note if an error occurred, such as the article being missing, corrupted, or unrelated to the claim.
-3. Populate the following table of probabilities based on your evaluation:
-   - **Label**:
-     - **Agrees**: Use this label if the article explicitly supports the claim.
-     - **Disagrees**: Use this label if the article explicitly opposes the claim.
-     - **Unrelated**: Use this label if the article does not discuss the claim or its related concepts.
-     - **An error occurred**: Use this label if there was an issue in processing or fetching the article.
-   - **Probability**: Provide a certainty score as a percentage (0%-100%) for each label.
-
-### Output Format:
-**Overall Comment:**  
-[Insert a concise explanation summarizing the reasoning for your evaluation.]
-
-| Label              | Probability |
-|--------------------|-------------|
-| Agrees             | [0-100]%    |
-| Disagrees          | [0-100]%    |
-| Unrelated          | [0-100]%    |
-| An error occurred  | [0-100]%    |
-
----
-
-**Claim:**  
-`"{claim}"`
-
-**Article:**  
-```  
-{article["content"]}
-```
-"""
-
-
-def load_model():
-    from unsloth import FastLanguageModel
-    import time
-
-    max_seq_length = 2048
-    dtype = None
-    model_name_or_path = "Eugenius0/lora_model_tuned"
-
-    # Load model
-    print("Loading model ...")
-    time_start = time.time()
-    model, tokenizer = FastLanguageModel.from_pretrained(
-        model_name=model_name_or_path,
-        max_seq_length=max_seq_length,
-        dtype=dtype,
-        load_in_4bit=True,
-    )
-    print(f"model loaded in {time.time() - time_start} s")
-    FastLanguageModel.for_inference(model)  # Enable native 2x faster inference
-    return model, tokenizer
-
-
-def infer_stance(claim, article, model_tokenizer=None):
-    try:
-        import torch
-        import time
-
-        if model_tokenizer == None:
-            model, tokenizer = load_model()
-        else:
-            model, tokenizer = model_tokenizer
-
-        title = article["title"]
-        publisher = article["publisher"]
-
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-
-        prompt = inference_prompt(claim, article)
-        messages = [
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ]
-        inputs = tokenizer.apply_chat_template(
-            messages,
-            tokenize=True,
-            add_generation_prompt=True,
-            return_tensors="pt",
-        ).to(device)
-
-        # Generate response
-        print(f"Analyzing article {title} from {publisher}...")
+@app.cls(
+    gpu=gpu,
+    image=claim_checker_image,
+    scaledown_window=300,
+    max_containers=MAX_CONTAINERS,
+)
+# The shard calls override this with `target_inputs=1`, see `modal_shard_model`.
+@modal.concurrent(max_inputs=MAX_INPUTS if CONTINUOUS_BATCHING else 1)
+class StanceModel:
+    """
+    Warm stance inference service.
+
+    The model is loaded once when the container starts and stays in GPU memory
+    between requests until the container is scaled down. Long articles are analyzed
+    in several chunks when the class is instantiated with `chunking=True`. A
+    container serves up to MAX_INPUTS requests at once, whose prompts share the
+    same batches, see `BatchScheduler`.
+    """
+
+    chunking: bool = modal.parameter(default=False)
+
+    @modal.enter()
+    def load(self):
         time_start = time.time()
-        outputs = model.generate(
-            input_ids=inputs,
-            max_new_tokens=256,
-            use_cache=True,
-            temperature=1.2,
-            repetition_penalty=1.1,
-            min_p=0.1,
+        self.model_tokenizer = load_model()
+        self.load_time = time.time() - time_start
+        self.prefix_cache = PrefixCache() if PREFIX_CACHE else None
+        self.scheduler = (
+            BatchScheduler(self.model_tokenizer, prefix_cache=self.prefix_cache)
+            if CONTINUOUS_BATCHING
+            else None
+        )
+        self.content_store = ContentStore()
+        self.cold_latency = None
+        self.warm_latencies = []
+
+    def _iter_infer_pairs(self, pairs, priority=INTERACTIVE):
+        with tracing.span(
+            "worker_inference", articles=len(pairs), priority=priority
+        ) as inference_span:
+            cold = self.cold_latency is None
+            time_start = time.time()
+            stats = {}
+            yield from iter_infer_pairs(
+                pairs,
+                self.model_tokenizer,
+                chunking=self.chunking,
+                stats=stats,
+                prefix_cache=self.prefix_cache,
+                scheduler=self.scheduler,
+                priority=priority,
+            )
+            latency = time.time() - time_start
+            inference_span.set(cold=cold, **stats)
+            print(f"Token usage: {stats}.")
+            if pairs:
+                prefill_time = stats.get("prefill_time", 0) / len(pairs)
+                print(f"Prefill: {prefill_time:.3f} s per article.")
+            if cold:
+                self.cold_latency = latency
+                print(
+                    f"Cold request: {len(pairs)} stances in {latency:.2f} s"
+                    f" (model loaded in {self.load_time:.2f} s)."
+                )
+            else:
+                self.warm_latencies.append(latency)
+                print(f"Warm request: {len(pairs)} stances in {latency:.2f} s.")
+
+    @modal.method()
+    def batch_infer_stances(self, claim, articles, priority=INTERACTIVE):
+        pairs = [(claim, article) for article in articles]
+        return [result for _, result in sorted(self._iter_infer_pairs(pairs, priority))]
+
+    @modal.method()
+    def stream_infer_stances(self, claim, articles, priority=INTERACTIVE):
+        """Yields (article index, raw result) pairs, to be called with `remote_gen`."""
+        yield from self._iter_infer_pairs(
+            [(claim, article) for article in articles], priority
         )
-        print(f"Done in {time.time() - time_start}.")
-        time_start = time.time()
-        response = tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
-        if len(response) > len(prompt):
-            return response[len(prompt) :]
-        return response
-    except Exception as e:
-        return f"Error while inferring stance: {e}"
-
 
-@app.function(gpu=gpu, image=claim_checker_image)
-def batch_infer_stances(claim, articles):
-    model_tokenizer = load_model()
-    return [infer_stance(claim, article, model_tokenizer) for article in articles]
+    @modal.method()
+    def batch_infer_pairs(self, pairs, priority=INTERACTIVE):
+        """
+        Returns the raw result of every (claim, article) pair, in order. The
+        articles of all the claims share the same GPU batches.
+        """
+        return [result for _, result in sorted(self._iter_infer_pairs(pairs, priority))]
+
+    @modal.method()
+    def stream_payload(self, payload):
+        """
+        Yields the encoded results of a request encoded with `encode_request`, to be
+        called with `remote_gen`, see `serve_payload`.
+        """
+        yield from serve_payload(payload, self.content_store, self._iter_infer_pairs)
+
+    @modal.method()
+    def stats(self):
+        return {
+            "load_time": self.load_time,
+            "cold_latency": self.cold_latency,
+            "warm_requests": len(self.warm_latencies),
+            "warm_latency_mean": (
+                sum(self.warm_latencies) / len(self.warm_latencies)
+                if self.warm_latencies
+                else None
+            ),
+            "scheduler": self.scheduler.metrics() if self.scheduler else None,
+            "spans": tracing.summary(),
+        }
 
 
 @app.local_entrypoint()  # defining a CLI entrypoint
@@ -177,5 +188,7 @@ def main(claim):
         return articles
 
     articles = query_articles(claim)
-    for response in batch_infer_stances.remote(claim, articles):
+    stance_model = StanceModel()
+    for response in stance_model.batch_infer_stances.remote(claim, articles):
         print(response)
+    print(stance_model.stats.remote())
@@ -0,0 +1,186 @@
+import asyncio
+import concurrent.futures
+import threading
+
+from query_articles import iter_articles
+from response_handler import parse_result
+from stance_cache import get_stance_cache
+from tracing import Span, current_span, run_in_context
+
+
+_end = object()  # Put in a queue after its last item.
+
+
+async def put_from_thread(queue, iterable, stopped):
+    """
+    Iterates the blocking `iterable` in a thread and puts its items in the asyncio
+    `queue`. When the queue is full, the iteration waits for the consumer, unless
+    `stopped` is set.
+    """
+    loop = asyncio.get_running_loop()
+
+    def run():
+        try:
+            for item in iterable:
+                future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+                while not stopped.is_set():
+                    try:
+                        future.result(timeout=0.5)
+                        break
+                    except concurrent.futures.TimeoutError:  # not TimeoutError in 3.10
+                        pass
+                else:
+                    future.cancel()
+                    return
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    await asyncio.to_thread(run_in_context(run))
+
+
+async def get_available(queue, max_items, wait):
+    """
+    Waits for an item of the queue, then takes the ones arriving within `wait`
+    seconds, up to `max_items` (None for no limit). Returns them and whether the
+    end of the queue was reached. Raises the exceptions found in the queue.
+    """
+    loop = asyncio.get_running_loop()
+    items = []
+    deadline = None
+    while max_items is None or len(items) < max_items:
+        if deadline is None:
+            item = await queue.get()
+            deadline = loop.time() + wait
+        else:
+            try:
+                item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+        if isinstance(item, Exception):
+            raise item
+        if item is _end:
+            return items, True
+        items.append(item)
+    return items, False
+
+
+async def verify_claim_pipeline(
+    claim,
+    num_articles,
+    stream_infer_stances,
+    stance_cache=None,
+    batch_size=None,
+    batch_wait=0.5,
+    queue_size=8,
+    **query_kwargs,
+):
+    """
+    Verifies the claim in stages connected by bounded queues, so that the first
+    articles are analyzed while the next ones are still being searched and scraped.
+
+    The articles are found by `iter_articles` (which prefetches the search results
+    in a thread) and sent to the model in micro-batches: as soon as an article is
+    scraped, it is inferred along with the articles scraped within `batch_wait`
+    seconds, and the next micro-batch gathers the articles scraped in the meantime.
+    The model is thus never idle while articles are waiting, and the batches grow
+    when the scraping is faster than the model. The raw results are then parsed.
+    When a queue is full the stage feeding it waits, so that the scraping doesn't
+    run far ahead of a slow model.
+
+    Parameters:
+    - claim: The claim to verify.
+    - num_articles: Number of articles analyzed.
+    - stream_infer_stances: Function streaming the raw results of a claim's
+      articles, like `StanceModel.stream_infer_stances`.
+    - stance_cache: `StanceCache` of the results, the process-wide one by default.
+    - batch_size: Maximum number of articles per inference call, None for all the
+      available ones.
+    - batch_wait: Seconds waited for more articles before an inference call.
+    - queue_size: Capacity of the queues between the stages.
+    - query_kwargs: Other parameters of `iter_articles`.
+
+    Yields:
+    - tuple: The rank of the article in the search results, the article and its
+      stance analysis (see `parse_result`), as the analyses are done.
+    """
+    stance_cache = stance_cache or get_stance_cache()
+    articles = asyncio.Queue(maxsize=queue_size)  # (rank, article)
+    results = asyncio.Queue(maxsize=queue_size)  # (rank, article, raw result)
+    analyses = asyncio.Queue(maxsize=queue_size)  # (rank, article, analysis)
+    stopped = threading.Event()
+
+    async def scrape():
+        try:
+            found = iter_articles(claim, num_articles, **query_kwargs)
+            await put_from_thread(articles, found, stopped)
+            await articles.put(_end)
+        except Exception as e:
+            await articles.put(e)
+
+    async def infer():
+        try:
+            finished = False
+            while not finished:
+                batch, finished = await get_available(articles, batch_size, batch_wait)
+                if not batch:
+                    continue
+                print(f"Inferring a micro-batch of {len(batch)} articles...")
+                inference_span = Span(
+                    "batch_infer_stances", parent=current_span(), articles=len(batch)
+                )
+                raw_results = stance_cache.stream(
+                    claim, [article for _, article in batch], stream_infer_stances
+                )
+                try:
+                    await put_from_thread(
+                        results, ((*batch[i], raw) for i, raw in raw_results), stopped
+                    )
+                except Exception:
+                    inference_span.end("error")
+                    raise
+                inference_span.end()
+            await results.put(_end)
+        except Exception as e:
+            await results.put(e)
+
+    async def parse():
+        while True:
+            item = await results.get()
+            if item is _end or isinstance(item, Exception):
+                await analyses.put(item)
+                return
+            rank, article, raw = item
+            await analyses.put((rank, article, parse_result(raw)))
+
+    stages = [asyncio.create_task(stage()) for stage in [scrape, infer, parse]]
+    try:
+        while True:
+            item = await analyses.get()
+            if item is _end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        for stage in stages:
+            stage.cancel()
+
+
+def iterate_async(async_iterable):
+    """
+    Iterates an async iterable from synchronous code, in an event loop of its own.
+    The threads still running when the iteration ends are not waited for.
+    """
+    loop = asyncio.new_event_loop()
+    iterator = aiter(async_iterable)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(anext(iterator))
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(iterator.aclose())
+        loop.close()
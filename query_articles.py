@@ -1,8 +1,19 @@
+import os
+import queue
+import random
+import threading
+import requests
 from requests.exceptions import HTTPError
-from googlesearch import search
-from newspaper import Article
 from urllib.parse import urlparse
-from time import sleep
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from article_cache import get_article_cache
+from dedup import get_duplicate_index
+from fetcher import get_fetcher, get_extraction_pool, extract_article
+from relevance import relevance_filter
+from search_cache import get_search_cache
+from tracing import span, run_in_context
 
 
 ignored_sites = ["reddit.com", "linkedin.com", "facebook.com", "x.com", "quora.com"]
@@ -45,86 +56,450 @@ def build_query(claim):
     return query
 
 
-def fetch_urls_generator(query):
+class TokenBucket:
+    """
+    Rate limiter allowing `rate` calls per second on average, with bursts of up to
+    `capacity` calls.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed."""
+        while True:
+            with self._lock:
+                now = monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            sleep(wait_time)
+
+
+# Google rate limits by IP address, so all the searches of the process share a bucket.
+google_rate_limiter = TokenBucket(rate=0.5, capacity=2)
+
+
+class GoogleSearchBackend:
+    """Search backend querying Google through googlesearch."""
+
+    def __init__(self, lang="en", rate_limiter=google_rate_limiter):
+        self.name = "google"
+        self.lang = lang
+        self.rate_limiter = rate_limiter
+
+    def search_page(self, query, start, num_results):
+        from googlesearch import search
+
+        return [
+            url
+            for url in search(
+                query,
+                num_results=num_results,
+                lang=self.lang,
+                start_num=start,
+                unique=True,
+            )
+            if url.startswith("http")
+        ]
+
+
+class HTTPSearchBackend:
+    """
+    Search backend querying a JSON search endpoint, e.g. a local fake search server
+    for tests and benchmarks. The endpoint receives the `q`, `start` and `num` query
+    parameters and answers with a JSON list of URLs.
+    """
+
+    def __init__(self, endpoint, rate_limiter=None, timeout=5):
+        self.name = endpoint
+        self.endpoint = endpoint
+        self.rate_limiter = rate_limiter or TokenBucket(rate=100, capacity=100)
+        self.timeout = timeout
+
+    def search_page(self, query, start, num_results):
+        response = requests.get(
+            self.endpoint,
+            params={"q": query, "start": start, "num": num_results},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+def default_search_backend():
     """
-    A generator function to yield an unlimited number of articles using googlesearch.
+    Returns the search backend used when none is given: Google, or the JSON search
+    endpoint set in the CLAIM_CHECKER_SEARCH_ENDPOINT environment variable.
+    """
+    endpoint = os.environ.get("CLAIM_CHECKER_SEARCH_ENDPOINT")
+    return HTTPSearchBackend(endpoint) if endpoint else GoogleSearchBackend()
+
+
+def search_page(backend, query, start, num_results, max_retries=4, backoff=2.0):
+    """
+    Fetches a page of search results, waiting for the backend's rate limiter and
+    retrying with exponential backoff when the backend answers "429 Too Many
+    Requests".
+    """
+    with span("search_page", start=start) as page_span:
+        for attempt in range(max_retries + 1):
+            page_span.set(attempts=attempt + 1)
+            backend.rate_limiter.acquire()
+            try:
+                results = backend.search_page(query, start, num_results)
+                page_span.set(results=len(results))
+                return results
+            except HTTPError as e:
+                if e.response is None or e.response.status_code != 429:
+                    raise
+                if attempt == max_retries:
+                    raise RuntimeError(
+                        "Too many queries. Service is temporary unavailable due to google search restrictions."
+                    ) from e
+                retry_after = e.response.headers.get("Retry-After", "")
+                delay = (
+                    float(retry_after)
+                    if retry_after.isdigit()
+                    else backoff * 2**attempt * (1 + random.random())
+                )
+                print(f"Search rate limited, retrying in {delay:.1f} s.")
+                sleep(delay)
+
+
+def fetch_urls_generator(
+    query,
+    backend=None,
+    page_size=10,
+    max_pages=10,
+    prefetch=20,
+    cache=None,
+    deadline=None,
+):
+    """
+    A generator function to yield the URLs of the search results, one per site.
+
+    The result pages are fetched in a background thread that keeps up to `prefetch`
+    URLs ready for the scraper. It goes through the pages of results until a page
+    brings no new site or `max_pages` pages have been read. The generator ends at
+    the `deadline` even if a page is still being fetched (e.g. retried after being
+    rate limited).
 
     Parameters:
     - query: Search query string.
+    - backend: Search backend, see `default_search_backend` for the default.
+    - page_size: Number of results per page.
+    - max_pages: Maximum number of pages fetched.
+    - prefetch: Maximum number of URLs fetched ahead of the consumer.
+    - cache: `SearchCache` the pages are looked up in before searching, if any.
+    - deadline: `monotonic` time after which no more URLs are waited for, if any.
 
     Yields:
     - URLs of search results (articles).
     """
-    while True:
-        # Fetch search results using googlesearch
+    backend = backend or default_search_backend()
+    buffer = queue.Queue(maxsize=prefetch)
+    stopped = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
         fetched_sites = set()
-        start = 0
-        print("query:", query)
-        results = search(
-            query,
-            num_results=10,
-            sleep_interval=int(start / 5),
-            lang="en",
-        )
+        with span("fetch_urls_generator") as search_span:
+            try:
+                print("query:", query)
+                for page in range(max_pages):
+                    start = page * page_size
+                    if cache is None:
+                        results = search_page(backend, query, start, page_size)
+                    else:
+                        results, status = cache.get(
+                            backend, query, start, page_size, search_page
+                        )
+                        search_span.add(cached_pages=int(status != "miss"))
+                    search_span.add(pages=1)
+                    new_sites = 0
+                    for result in results:
+                        site = urlparse(result).hostname
+                        if site in fetched_sites:
+                            continue
+                        fetched_sites.add(site)
+                        new_sites += 1
+                        search_span.add(urls=1)
+                        if not put(result):
+                            return
+                    if new_sites == 0:
+                        break
+                put(end)
+            except Exception as e:
+                search_span.outcome = "error"
+                search_span.set(error=repr(e))
+                put(e)
+
+    threading.Thread(target=run_in_context(produce), daemon=True).start()
+    try:
+        while True:
+            try:
+                timeout = None if deadline is None else max(deadline - monotonic(), 0)
+                item = buffer.get(timeout=timeout)
+            except queue.Empty:
+                print("No more search results before the deadline.")
+                return
+            if item is end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
 
-        # Yield each result
-        for result in results:
-            site = urlparse(result).hostname
-            if site not in fetched_sites:
-                query += f" -site:{site}"
-                fetched_sites.add(site)
-                yield result
 
-        # Move to the next batch of results
-        sleep(2.0)
+def scrape_article(url, request_timeout=7, cache_entry=None):
+    """
+    Downloads the article at `url` with the shared HTTP fetcher, then extracts its
+    text in the extraction process pool, so that parsing a page doesn't hold the
+    GIL needed by the threads downloading the other pages.
 
-        # except HTTPError as e:
-        #     print(f"Error occurred during search: {e}")
-        #     if "429 Client Error: Too Many Requests for" in e:
-        #         raise RuntimeError("Too many queries. Service is temporary unavailable due to google search restrictions.")
-        #     break
+    When the (expired) `cache_entry` of the URL is given, the download is
+    conditional and the cached article is returned if the page didn't change.
+    The returned article holds the "etag" and "last_modified" validators of the
+    page, to be stored in the article cache.
+    """
+    with span("scrape_article", url=url) as scrape_span:
+        try:
+            response = get_fetcher().fetch(
+                url,
+                request_timeout,
+                etag=cache_entry and cache_entry["etag"],
+                last_modified=cache_entry and cache_entry["last_modified"],
+            )
+            scrape_span.set(status=response["status"])
+            if response["status"] == 304:
+                extracted = cache_entry
+            else:
+                scrape_span.set(bytes_downloaded=len(response["html"]))
+                with span("extract_article"):
+                    extracted = (
+                        get_extraction_pool()
+                        .submit(extract_article, url, response["html"])
+                        .result()
+                    )
+            publisher = (
+                urlparse(url).netloc.split(".")[-2].capitalize()
+            )  # Extract publisher's name
+            scrape_span.set(content_chars=len(extracted["content"]))
+            return {
+                "title": extracted["title"],
+                "content": extracted["content"],
+                "url": url,
+                "publisher": publisher,
+                "etag": response["etag"],
+                "last_modified": response["last_modified"],
+            }
+        except Exception as e:
+            scrape_span.outcome = "failed"
+            scrape_span.set(error=repr(e))
+            print(f"Failed to fetch article from {url}: {e}")
 
 
-def scrape_article(url):
-    try:
-        article = Article(url)
-        article.download()
-        article.parse()
-        publisher = (
-            urlparse(url).netloc.split(".")[-2].capitalize()
-        )  # Extract publisher's name
-        return {
-            "title": article.title,
-            "content": article.text,
-            "url": url,
-            "publisher": publisher,
-        }
-    except Exception as e:
-        print(f"Failed to fetch article from {url}: {e}")
-
-
-def query_articles(claim, num_articles=3):
+def iter_articles(
+    claim,
+    num_articles=3,
+    max_workers=8,
+    overfetch=2,
+    url_timeout=15,
+    total_timeout=60,
+    max_urls=100,
+    use_cache=True,
+    search_backend=None,
+    scraper=scrape_article,
+    relevance_filter=relevance_filter,
+    duplicate_index=None,
+):
+    """
+    Search for articles about the claim and scrape them concurrently, yielding the
+    articles as soon as they are scraped.
+
+    Candidate URLs are scraped in a thread pool. Up to `overfetch` times the number
+    of missing articles are kept in flight (bounded by `max_workers`) so that slow or
+    failing sites don't stall the whole query. As soon as `num_articles` articles are
+    scraped the remaining downloads are abandoned. Articles that the relevance
+    filter finds unrelated to the claim are dropped and replaced by the next
+    search results. The near-duplicates of articles seen before, for this claim or
+    previous ones, are marked with the content hash of the original article as
+    `duplicate_of`, so that they share its stance. New downloads are only started
+    when the consumer asks for the next article.
+
+    Parameters:
+    - claim: The claim to find articles about.
+    - num_articles: Number of articles to return.
+    - max_workers: Maximum number of concurrent downloads.
+    - overfetch: Number of URLs scraped in parallel per missing article.
+    - url_timeout: Seconds after which a single URL is given up on.
+    - total_timeout: Seconds after which the query returns whatever it has.
+    - max_urls: Maximum number of URLs tried, as a safety measure.
+    - use_cache: Whether to look up the search results and the articles in the
+      search and article caches, and to store the new ones.
+    - search_backend: Backend of the search, see `fetch_urls_generator`.
+    - scraper: Function scraping a URL, with the signature of `scrape_article`.
+    - relevance_filter: `RelevanceFilter` deciding which articles are worth
+      analyzing, None to keep them all.
+    - duplicate_index: `DuplicateIndex` of the articles seen before, the
+      process-wide one by default.
+
+    Yields:
+    - tuple: The rank of the article in the search results and the article.
+    """
     print(f"Fetching URLs for query: {claim}")
 
     # Fetch URLs
     query = build_query(claim)
     # query = f'"{claim}" + ("article" OR "news" OR "opinion" OR "editorial" OR "analysis" OR "myth" OR "false" OR "debunked" OR "controversial" OR "opposes" OR "criticizes" OR "not true" OR "challenges" OR "opposite" OR "alternatives to" OR "against" OR "evidence" OR "supports" OR "proves" OR "validated" OR "confirmed" OR "true" OR "endorses" OR "advocates for" OR "affirms" OR "shows that") -pdf -site:reddit.com -site:linkedin.com -site:facebook.com'
-    urls_generator = fetch_urls_generator(query)
-
-    articles = []
-
-    for i, url in enumerate(urls_generator):
-        if i >= 100:
-            break  # safety measure to limit the number of scraped article
-        if len(articles) >= num_articles:
-            break
-        print(f"\nScraping {url}...")
-        article = scrape_article(url)
-        if article:
-            print("\nScraped Content (First 500 characters):")
-            print(article["content"][:500])
-            articles.append(article)
-        else:
-            print("\nFailed to scrape content.")
-
-    return articles
+    deadline = monotonic() + total_timeout
+    urls_generator = fetch_urls_generator(
+        query,
+        search_backend,
+        cache=get_search_cache() if use_cache else None,
+        deadline=deadline,
+    )
+
+    num_found = 0
+    in_flight = {}  # future -> (search rank, url, start time)
+    num_urls = 0
+    num_dropped = 0
+    num_duplicates = 0
+    urls_exhausted = False
+    cache = get_article_cache() if use_cache else None
+    duplicate_index = duplicate_index or get_duplicate_index()
+
+    def accept(article):
+        nonlocal num_dropped, num_duplicates
+        if relevance_filter is None or relevance_filter.accept(claim, article):
+            if duplicate_index.annotate(article):
+                num_duplicates += 1
+                print(f"\n{article['url']} is a near-duplicate of a known article.")
+            return True
+        num_dropped += 1
+        print(
+            f"\nDropped {article['url']}, unrelated to the claim"
+            f" (relevance {article['relevance']:.2f})."
+        )
+        return False
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    with span("query_articles") as query_span:
+        try:
+            while num_found < num_articles and monotonic() < deadline:
+                # Speculatively keep more downloads running than strictly needed.
+                while (
+                    len(in_flight)
+                    < min(max_workers, (num_articles - num_found) * overfetch)
+                    and not urls_exhausted
+                ):
+                    if num_urls >= max_urls:
+                        # safety measure to limit the number of scraped article
+                        urls_exhausted = True
+                        break
+                    url = next(urls_generator, None)
+                    if url is None:
+                        urls_exhausted = True
+                        break
+                    cached = cache.get(url) if cache else None
+                    if cached:
+                        print(f"\nFound {url} in the article cache.")
+                        num_urls += 1
+                        if accept(cached):
+                            num_found += 1
+                            yield num_urls - 1, cached
+                            if num_found == num_articles:
+                                break
+                        continue
+                    # An expired entry still allows a conditional download.
+                    entry = cache.get_entry(url) if cache else None
+                    if entry and not (entry["etag"] or entry["last_modified"]):
+                        entry = None
+                    print(f"\nScraping {url}...")
+                    future = executor.submit(
+                        run_in_context(scraper), url, url_timeout, cache_entry=entry
+                    )
+                    in_flight[future] = (num_urls, url, monotonic())
+                    num_urls += 1
+
+                if not in_flight or num_found == num_articles:
+                    break
+
+                # Wake up for the closest per-URL or overall deadline.
+                now = monotonic()
+                next_deadline = min(
+                    deadline,
+                    *(start + url_timeout for _, _, start in in_flight.values()),
+                )
+                done, _ = wait(
+                    in_flight,
+                    timeout=max(next_deadline - now, 0),
+                    return_when=FIRST_COMPLETED,
+                )
+
+                for future in sorted(done, key=lambda future: in_flight[future][0]):
+                    rank, url, _ = in_flight.pop(future)
+                    article = future.result()
+                    if article:
+                        etag = article.pop("etag", None)
+                        last_modified = article.pop("last_modified", None)
+                        print(f"\nScraped Content from {url} (First 500 characters):")
+                        print(article["content"][:500])
+                        if cache:
+                            cache.put(url, article, etag, last_modified)
+                        if num_found < num_articles and accept(article):
+                            num_found += 1
+                            yield rank, article
+                    else:
+                        print(f"\nFailed to scrape content from {url}.")
+
+                now = monotonic()
+                for future, (rank, url, start) in list(in_flight.items()):
+                    if now - start >= url_timeout:
+                        print(f"\nGave up on {url} after {url_timeout} s.")
+                        future.cancel()
+                        del in_flight[future]
+        finally:
+            # Don't wait for the stragglers, their results are not needed anymore.
+            executor.shutdown(wait=False, cancel_futures=True)
+            urls_generator.close()
+            if num_found < num_articles:
+                print(f"\nOnly found {num_found} articles out of {num_articles}.")
+            query_span.set(
+                urls_tried=num_urls,
+                articles=num_found,
+                articles_dropped=num_dropped,
+                duplicates=num_duplicates,
+            )
+
+
+def query_articles(claim, num_articles=3, **kwargs):
+    """
+    Search for articles about the claim and scrape them concurrently, see
+    `iter_articles` for the parameters.
+
+    Returns:
+    - The scraped articles, ordered by their rank in the search results.
+    """
+    articles = sorted(iter_articles(claim, num_articles, **kwargs), key=lambda x: x[0])
+    return [article for _, article in articles]
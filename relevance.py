@@ -0,0 +1,163 @@
+import math
+import os
+import random
+import re
+import threading
+from collections import Counter
+
+
+# Articles scoring below this are not sent to the model, 0 disables the filter.
+RELEVANCE_THRESHOLD = float(os.environ.get("CLAIM_CHECKER_RELEVANCE_THRESHOLD", 0.2))
+
+stopwords = set(
+    """
+    a about above after again against all also am an and any are as at be because
+    been before being below between both but by can could did do does doing down
+    during each few for from further had has have having he her here hers him his
+    how i if in into is it its itself just me more most my no nor not now of off on
+    once only or other our out over own same she should so some such than that the
+    their them then there these they this those through to too under until up very
+    was we were what when where which while who whom why will with would you your
+    """.split()
+)
+
+
+def tokenize(text):
+    """Lowercase words of the text without stopwords, crudely stemmed."""
+    terms = []
+    for word in re.findall(r"\w+", text.lower()):
+        if len(word) <= 2 or word in stopwords:
+            continue
+        if len(word) > 4 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+class RelevanceFilter:
+    """
+    Cheap CPU estimate of whether an article is related to a claim, to avoid
+    running the model on articles it would label "unrelated".
+
+    Articles are scored with BM25 against the terms of the claim, relative to the
+    score of an article of average length holding each term once (capped at 1), so
+    that one threshold suits claims of any length. The document frequencies come
+    from the articles scored before by the process, an article being added to them
+    once scored. Articles below `threshold` are
+    dropped, except for a random `audit_rate` share of them, which are let through
+    to measure how often the filter disagrees with the model (see `record_stance`).
+
+    Parameters:
+    - threshold: Minimum normalized score of the articles kept.
+    - audit_rate: Share of the dropped articles still sent to the model.
+    - k1, b: BM25 parameters.
+    """
+
+    def __init__(self, threshold=RELEVANCE_THRESHOLD, audit_rate=0.05, k1=1.2, b=0.75):
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.k1 = k1
+        self.b = b
+        self.documents = 0
+        self.total_length = 0
+        self.document_frequencies = Counter()
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def score(self, claim, article):
+        """Returns the normalized BM25 score of the article for the claim."""
+        claim_terms = set(tokenize(claim))
+        terms = tokenize(article["title"] + "\n" + article["content"])
+        frequencies = Counter(terms)
+        with self._lock:
+            idf = {
+                term: math.log(
+                    1
+                    + (self.documents - self.document_frequencies[term] + 0.5)
+                    / (self.document_frequencies[term] + 0.5)
+                )
+                for term in claim_terms
+            }
+            average_length = (
+                self.total_length / self.documents if self.documents else len(terms)
+            )
+            self.documents += 1
+            self.total_length += len(terms)
+            self.document_frequencies.update(set(terms))
+
+        if not claim_terms:
+            return 1.0
+        norm = self.k1 * (1 - self.b + self.b * len(terms) / max(average_length, 1))
+        score = sum(
+            idf[term]
+            * frequencies[term]
+            * (self.k1 + 1)
+            / (frequencies[term] + norm)
+            for term in claim_terms
+        )
+        reference = sum(idf.values())
+        return min(score / reference, 1.0) if reference else 0.0
+
+    def accept(self, claim, article):
+        """
+        Scores the article and tells whether it should be analyzed by the model.
+        The score and decision are stored in the article.
+        """
+        if self.threshold <= 0:
+            return True
+        article["relevance"] = self.score(claim, article)
+        relevant = article["relevance"] >= self.threshold
+        with self._lock:
+            self.counts["scored"] += 1
+            if not relevant:
+                self.counts["dropped"] += 1
+                if random.random() < self.audit_rate:
+                    self.counts["audited"] += 1
+                    article["relevance_audit"] = True
+                    return True
+        return relevant
+
+    def record_stance(self, article, stance):
+        """
+        Compares the decision of the filter on the article with the stance given by
+        the model, to measure how often they disagree.
+        """
+        if "relevance" not in article or stance == "error":
+            return
+        with self._lock:
+            if article.get("relevance_audit"):
+                self.counts["audit_results"] += 1
+                if stance != "unrelated":
+                    self.counts["dropped_related"] += 1
+            else:
+                self.counts["kept_results"] += 1
+                if stance == "unrelated":
+                    self.counts["kept_unrelated"] += 1
+
+    def stats(self):
+        """
+        Returns the number of articles scored and dropped, the model calls saved,
+        and the disagreements with the model: the share of audited dropped articles
+        it found related, and of the kept ones it found unrelated.
+        """
+        with self._lock:
+            counts = dict(self.counts)
+        audit_results = counts.get("audit_results", 0)
+        kept_results = counts.get("kept_results", 0)
+        return {
+            "scored": counts.get("scored", 0),
+            "dropped": counts.get("dropped", 0),
+            "gpu_calls_saved": counts.get("dropped", 0) - counts.get("audited", 0),
+            "audited": counts.get("audited", 0),
+            "dropped_related_rate": (
+                counts.get("dropped_related", 0) / audit_results
+                if audit_results
+                else None
+            ),
+            "kept_unrelated_rate": (
+                counts.get("kept_unrelated", 0) / kept_results if kept_results else None
+            ),
+        }
+
+
+relevance_filter = RelevanceFilter()
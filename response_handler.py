@@ -1,12 +1,22 @@
 import re
 
+from tracing import traced
 
+
+# Joins the results of the chunks of an article.
+CHUNK_SEPARATOR = "\n\n<<< next chunk >>>\n\n"
+
+
+@traced("parse_result")
 def parse_result(result_text, error_threshold=5):
     """
     Parses the output to extract an overall comment and probabilities for 'agrees',
     'disagrees', and 'unrelated'. If the "An error occurred" label probability exceeds
     the error_threshold, set 'error_flag' to True.
 
+    If the text holds the results of several chunks of the same article (joined with
+    CHUNK_SEPARATOR), they are aggregated with `aggregate_chunk_results`.
+
     Args:
         result_text (str): The raw result text to parse.
         error_threshold (int): The threshold percentage for triggering the error flag.
@@ -15,6 +25,14 @@ def parse_result(result_text, error_threshold=5):
         dict: Parsed data with keys 'comment', 'agrees', 'disagrees',
               'unrelated', and 'error_flag'.
     """
+    if CHUNK_SEPARATOR in result_text:
+        return aggregate_chunk_results(
+            [
+                parse_result(chunk_text, error_threshold)
+                for chunk_text in result_text.split(CHUNK_SEPARATOR)
+            ]
+        )
+
     # Regular expressions for extracting data
     regex_patterns = {
         "comment": r"Overall Comment:\**\s+(.+)",
@@ -65,6 +83,39 @@ def parse_result(result_text, error_threshold=5):
     return parsed_data
 
 
+def aggregate_chunk_results(chunk_results):
+    """
+    Combines the parsed results of the chunks of one article.
+
+    An article is as related to the claim as its most related chunk, so the
+    probabilities are averaged over the chunks that are mostly related to the claim
+    (or taken from the most related chunk if there is none), and the comment is the
+    one of the most related chunk. Chunks flagged as errors are ignored unless they
+    all are.
+
+    Args:
+        chunk_results (list): The parsed result of each chunk.
+
+    Returns:
+        dict: Parsed data in the same format as `parse_result`.
+    """
+    valid = [result for result in chunk_results if not result["error_flag"]]
+    if not valid:
+        return chunk_results[0]
+
+    most_related = min(valid, key=lambda result: result["unrelated"])
+    related = [
+        result
+        for result in valid
+        if result["unrelated"] < result["agrees"] + result["disagrees"]
+    ] or [most_related]
+
+    aggregated = {"comment": most_related["comment"], "error_flag": False}
+    for key in ["agrees", "disagrees", "unrelated"]:
+        aggregated[key] = sum(result[key] for result in related) / len(related)
+    return aggregated
+
+
 def get_stance(analyze):
     if analyze["error_flag"]:
         return "error"
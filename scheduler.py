@@ -0,0 +1,314 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import deque
+
+from stance_cache import normalize_claim
+from tracing import Span
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed because the scheduler is overloaded."""
+
+
+class Computation:
+    """
+    A pipeline run shared by all the requests for the same claim. It keeps the
+    latest value yielded by the pipeline and wakes up the requests waiting for it.
+    """
+
+    def __init__(self, key, args):
+        self.key = key
+        self.args = args
+        self.subscribers = 1
+        self.version = 0  # Incremented at every update.
+        self.value = None
+        self.error = None
+        self.done = False
+        self.queue_span = Span("scheduler_queue", claim=args[0])
+        self.condition = threading.Condition()
+        self.waiters = set()  # (event loop, asyncio.Event) of the async requests
+
+    def publish(self, value=None, error=None, done=False):
+        with self.condition:
+            if error is not None:
+                self.error = error
+            elif not done:
+                self.value = value
+            self.done = done
+            self.version += 1
+            self.condition.notify_all()
+            for loop, updated in self.waiters:
+                try:
+                    loop.call_soon_threadsafe(updated.set)
+                except RuntimeError:
+                    pass  # The event loop is closed.
+
+
+class ClaimScheduler:
+    """
+    Runs a pipeline for the claims submitted by concurrent users.
+
+    Requests for the same claim (after normalization) while it is queued or running
+    share a single run of the pipeline. At most `max_pipelines` runs happen at once,
+    in a fixed pool of threads; the other claims wait in a FIFO queue whose position
+    and estimated wait are reported to the requests. When the queue holds
+    `max_queue` claims, or the estimated wait exceeds `max_wait` seconds, new claims
+    are rejected with `Overloaded` instead of piling up. So are the requests beyond
+    `max_subscribers` following the claims at once, joiners of a claim in progress
+    included, since each of them holds a thread (or a connection).
+
+    Parameters:
+    - pipeline: Generator function called with the claim and the number of articles,
+      yielding the successive results of a verification.
+    - max_pipelines: Maximum number of pipelines running at once.
+    - max_queue: Maximum number of claims waiting for a pipeline.
+    - max_wait: Maximum estimated wait, in seconds, before requests are shed.
+    - max_subscribers: Maximum number of requests following the claims at once.
+    - expected_duration: Duration of a pipeline run assumed before any has finished.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        max_pipelines=4,
+        max_queue=16,
+        max_wait=300,
+        max_subscribers=64,
+        expected_duration=30,
+    ):
+        self.pipeline = pipeline
+        self.max_pipelines = max_pipelines
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_subscribers = max_subscribers
+        self.mean_duration = expected_duration
+        self.submitted = 0
+        self.coalesced = 0
+        self.shed = 0
+        self.completed = 0
+        self._waiting = deque()
+        self._computations = {}  # key -> queued or running computation
+        self._running = 0
+        self._subscribers = 0
+        self._lock = threading.Lock()
+        self._work_available = threading.Condition(self._lock)
+        for _ in range(max_pipelines):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def estimated_wait(self, position):
+        """
+        Seconds before the claim at `position` in the queue starts running, 0 if a
+        pipeline is free for it.
+        """
+        with self._lock:
+            free = self.max_pipelines - self._running
+        return self._wait(max(position - free, 0))
+
+    def _wait(self, ahead):
+        """Seconds of wait behind `ahead` claims that won't find a free pipeline."""
+        return ahead / self.max_pipelines * self.mean_duration
+
+    def position(self, computation):
+        """Position of the computation in the queue (1 is next), 0 once running."""
+        with self._lock:
+            try:
+                return self._waiting.index(computation) + 1
+            except ValueError:
+                return 0
+
+    def submit(self, claim, num_articles=6):
+        """
+        Returns the computation verifying the claim, joining the one in progress for
+        the same claim if any. Raises `Overloaded` if the claim can't be queued.
+        """
+        key = (normalize_claim(claim), num_articles)
+        with self._lock:
+            self.submitted += 1
+            computation = self._computations.get(key)
+            # Claims ahead of this one that won't find a free pipeline.
+            ahead = max(len(self._waiting) + self._running + 1 - self.max_pipelines, 0)
+            if self._subscribers >= self.max_subscribers or (
+                computation is None
+                and (
+                    len(self._waiting) >= self.max_queue
+                    or self._wait(ahead) > self.max_wait
+                )
+            ):
+                self.shed += 1
+                raise Overloaded(
+                    "The server is busy verifying other claims, please try again in"
+                    " a few minutes."
+                )
+
+            self._subscribers += 1
+            if computation is not None:
+                self.coalesced += 1
+                computation.subscribers += 1
+                return computation
+
+            computation = Computation(key, (claim, num_articles))
+            self._computations[key] = computation
+            self._waiting.append(computation)
+            self._work_available.notify()
+            return computation
+
+    def unsubscribe(self, computation):
+        """
+        Stops following the computation. A queued computation that no request
+        follows anymore is dropped from the queue.
+        """
+        with self._lock:
+            self._subscribers -= 1
+            computation.subscribers -= 1
+            if computation.subscribers == 0 and computation in self._waiting:
+                self._waiting.remove(computation)
+                del self._computations[computation.key]
+                computation.queue_span.end("cancelled")
+
+    def stream(self, claim, num_articles=6):
+        """
+        Verifies the claim through the scheduler.
+
+        Yields:
+        - ("queued", position, estimated wait in seconds) while the claim waits for
+          a pipeline, every time the position changes.
+        - ("result", value) for every value yielded by the pipeline. A request
+          joining a running computation first gets its latest value.
+
+        Raises:
+        - Overloaded: If the claim is shed.
+        """
+        computation = self.submit(claim, num_articles)
+        try:
+            seen_version = 0
+            last_position = None
+            last_value = None
+            while True:
+                position = self.position(computation)
+                if position and position != last_position:
+                    wait = self.estimated_wait(position)
+                    if wait:  # Else the claim starts right away.
+                        yield "queued", position, wait
+                last_position = position
+
+                with computation.condition:
+                    if computation.version == seen_version:
+                        computation.condition.wait(timeout=1)
+                    if computation.version == seen_version:
+                        continue  # Only check the queue position again.
+                    seen_version = computation.version
+                    value, error = computation.value, computation.error
+                    done = computation.done
+
+                if error is not None:
+                    raise error
+                if value is not None and value is not last_value:
+                    last_value = value
+                    yield "result", value
+                if done:
+                    return
+        finally:
+            self.unsubscribe(computation)
+
+    async def astream(self, claim, num_articles=6):
+        """
+        Verifies the claim through the scheduler like `stream`, for asyncio code:
+        the request waits for the updates in the event loop instead of holding a
+        thread, so that many requests can follow the claims at once.
+        """
+        computation = self.submit(claim, num_articles)
+        updated = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), updated)
+        with computation.condition:
+            computation.waiters.add(waiter)
+        try:
+            seen_version = 0
+            last_position = None
+            last_value = None
+            while True:
+                position = self.position(computation)
+                if position and position != last_position:
+                    wait = self.estimated_wait(position)
+                    if wait:  # Else the claim starts right away.
+                        yield "queued", position, wait
+                last_position = position
+
+                updated.clear()
+                with computation.condition:
+                    version = computation.version
+                    value, error = computation.value, computation.error
+                    done = computation.done
+                if version == seen_version:
+                    try:
+                        # Only check the queue position again after a second.
+                        await asyncio.wait_for(updated.wait(), timeout=1)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                seen_version = version
+
+                if error is not None:
+                    raise error
+                if value is not None and value is not last_value:
+                    last_value = value
+                    yield "result", value
+                if done:
+                    return
+        finally:
+            with computation.condition:
+                computation.waiters.discard(waiter)
+            self.unsubscribe(computation)
+
+    def _work(self):
+        while True:
+            with self._work_available:
+                while not self._waiting:
+                    self._work_available.wait()
+                computation = self._waiting.popleft()
+                self._running += 1
+            computation.queue_span.end()
+
+            time_start = time.time()
+            try:
+                for value in self.pipeline(*computation.args):
+                    computation.publish(value)
+            except Exception as e:
+                computation.publish(error=e)
+            finally:
+                with self._lock:
+                    del self._computations[computation.key]
+                    self._running -= 1
+                    self.completed += 1
+                    # Exponential moving average of the pipeline duration.
+                    duration = time.time() - time_start
+                    self.mean_duration = 0.8 * self.mean_duration + 0.2 * duration
+                computation.publish(done=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "shed": self.shed,
+                "completed": self.completed,
+                "running": self._running,
+                "queued": len(self._waiting),
+                "subscribers": self._subscribers,
+                "mean_duration": self.mean_duration,
+            }
+
+
+def limit_concurrency(generator_function, semaphore):
+    """
+    Wraps a generator function so that at most as many generators as the semaphore
+    allows are iterated at once. The others block until a slot is released.
+    """
+
+    @functools.wraps(generator_function)
+    def wrapper(*args, **kwargs):
+        with semaphore:
+            yield from generator_function(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,181 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from article_cache import CACHE_DIR
+from tracing import run_in_context
+
+
+# Seconds during which cached search results are served without searching again.
+SEARCH_TTL = float(os.environ.get("CLAIM_CHECKER_SEARCH_TTL", 24 * 3600))
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+class SearchCache:
+    """
+    Persistent cache of the pages of search results, stored in a SQLite database.
+
+    A page is keyed by the normalized query, the search backend and its language,
+    and the position of the page in the results, and holds the ordered list of its
+    URLs. The pages of a query are cached one at a time as they are needed, so that
+    the cached results of a claim are extended when more articles are needed.
+    Pages younger than `ttl` seconds are served from the cache. Older pages, up to
+    `max_stale` seconds, are still served right away but fetched again in the
+    background to refresh the cache (stale-while-revalidate). When the cache holds
+    more than `max_entries` pages, the oldest ones are evicted.
+
+    Parameters:
+    - directory: Directory holding the database file.
+    - ttl: Lifetime of a page in seconds.
+    - max_stale: Age in seconds up to which an expired page is still served.
+    - max_entries: Maximum number of pages in the cache.
+    """
+
+    def __init__(
+        self,
+        directory=CACHE_DIR,
+        ttl=SEARCH_TTL,
+        max_stale=7 * 24 * 3600,
+        max_entries=10_000,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.max_entries = max_entries
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self._revalidating = set()  # keys of the pages being fetched again
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "searches.sqlite"), check_same_thread=False
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS searches"
+            " (key TEXT PRIMARY KEY, urls TEXT, fetched_at REAL)"
+        )
+        self._connection.commit()
+
+    def key(self, backend, query, start, num_results):
+        return json.dumps(
+            [
+                normalize_query(query),
+                backend.name,
+                getattr(backend, "lang", None),
+                start,
+                num_results,
+            ]
+        )
+
+    def get(self, backend, query, start, num_results, search_page):
+        """
+        Returns the URLs of a page of search results, from the cache if possible,
+        else from `search_page(backend, query, start, num_results)`, whose results
+        are then cached.
+
+        Returns:
+        - list: The URLs of the page, in order.
+        - str: "hit", "stale" (the page is being revalidated) or "miss".
+        """
+        key = self.key(backend, query, start, num_results)
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT urls, fetched_at FROM searches WHERE key = ?", (key,)
+            ).fetchone()
+        age = time.time() - row[1] if row else None
+        if row and age <= self.ttl:
+            status = "hit"
+        elif row and age <= self.max_stale:
+            status = "stale"
+            self._revalidate(
+                key, lambda: search_page(backend, query, start, num_results)
+            )
+        else:
+            status = "miss"
+        with self._lock:
+            if status == "hit":
+                self.hits += 1
+            elif status == "stale":
+                self.stale_hits += 1
+            else:
+                self.misses += 1
+        if status != "miss":
+            return json.loads(row[0]), status
+
+        urls = search_page(backend, query, start, num_results)
+        self.put(key, urls)
+        return urls, status
+
+    def _revalidate(self, key, fetch):
+        """Fetches the page again in the background, unless it already is."""
+        with self._lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+            self.revalidations += 1
+
+        def revalidate():
+            try:
+                self.put(key, fetch())
+            except Exception as e:
+                print(f"Failed to revalidate a page of search results: {e}")
+            finally:
+                with self._lock:
+                    self._revalidating.discard(key)
+
+        threading.Thread(target=run_in_context(revalidate), daemon=True).start()
+
+    def put(self, key, urls):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                (key, json.dumps(urls), time.time()),
+            )
+            self._connection.execute(
+                "DELETE FROM searches WHERE key NOT IN"
+                " (SELECT key FROM searches ORDER BY fetched_at DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM searches")
+            self._connection.commit()
+
+    def stats(self):
+        """
+        Returns the lookup counters, the hit ratio (stale hits included), and the
+        number of searches avoided, i.e. of pages served without any search.
+        """
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_ratio": (
+                    (self.hits + self.stale_hits) / lookups if lookups else None
+                ),
+                "searches_avoided": self.hits,
+                "revalidations": self.revalidations,
+            }
+
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache():
+    """Returns the process-wide search cache, created on first use."""
+    global _search_cache
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache()
+    return _search_cache
@@ -0,0 +1,145 @@
+import functools
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import span, run_in_context
+
+
+# Articles per shard of the sharded inference, 0 infers the articles of a claim in
+# a single call.
+SHARD_SIZE = int(os.environ.get("CLAIM_CHECKER_SHARD_SIZE", 0))
+# Maximum number of shards of a call inferred at once (GPU containers for Modal).
+MAX_CONTAINERS = int(os.environ.get("CLAIM_CHECKER_MAX_CONTAINERS", 4))
+
+
+def shard(items, shard_size, max_shards=None):
+    """
+    Splits the items into consecutive shards of `shard_size` items, or of more items
+    if that makes more than `max_shards` shards.
+    """
+    if max_shards:
+        shard_size = max(shard_size, math.ceil(len(items) / max_shards))
+    return [items[i : i + shard_size] for i in range(0, len(items), shard_size)]
+
+
+def modal_starmap(function, **kwargs):
+    """
+    Returns the `starmap` of a Modal function (or class method), yielding the result
+    or the exception of every call, in order. The keyword arguments are passed to
+    every call.
+    """
+    return functools.partial(
+        function.starmap, kwargs=kwargs, order_outputs=True, return_exceptions=True
+    )
+
+
+def modal_shard_model(cls, max_inputs=8):
+    """
+    Returns an instance of the Modal class `cls` for the shard calls. Its containers
+    target a single input (`target_inputs=1`), so that the shards of a claim start
+    new containers, up to `max_containers`, instead of all joining the batches of a
+    warm one; only then do they take up to `max_inputs` inputs (`MAX_INPUTS` of the
+    Modal class). The other calls keep the batching configuration of the class.
+    """
+    return cls.with_concurrency(max_inputs=max_inputs, target_inputs=1)()
+
+
+def local_starmap(function, max_workers=MAX_CONTAINERS):
+    """
+    Local stand-in for `modal_starmap`, calling `function` in a pool of
+    `max_workers` threads instead of remote containers.
+    """
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def call(arguments):
+        try:
+            return function(*arguments)
+        except Exception as e:
+            return e
+
+    def starmap(argument_tuples):
+        futures = [
+            executor.submit(run_in_context(call), arguments)
+            for arguments in argument_tuples
+        ]
+        for future in futures:
+            yield future.result()
+
+    return starmap
+
+
+class ShardedInference:
+    """
+    Infers the stances of the articles of a claim in parallel shards, e.g. on
+    several GPU containers, so that the latency doesn't grow with the number of
+    articles.
+
+    The (claim, article) pairs are split into shards of `shard_size` consecutive
+    pairs (larger ones if that makes more than `max_shards` shards), all sent at
+    once through `starmap`, and their results are reassembled in the order of the
+    pairs. The shards that fail are sent again, up to `max_retries` times.
+
+    Parameters:
+    - starmap: Function calling `batch_infer_pairs` with every argument tuple it is
+      given, and yielding the results (or the exceptions raised) in order, see
+      `modal_starmap` and `local_starmap`.
+    - shard_size: Number of pairs per shard.
+    - max_shards: Maximum number of shards per call, e.g. of GPU containers.
+    - max_retries: Number of times a failed shard is retried.
+    """
+
+    def __init__(self, starmap, shard_size=4, max_shards=MAX_CONTAINERS, max_retries=2):
+        self.starmap = starmap
+        self.shard_size = shard_size
+        self.max_shards = max_shards
+        self.max_retries = max_retries
+
+    def stream_infer_pairs(self, pairs):
+        """
+        Yields (pair index, raw result) pairs, a shard at a time as they complete.
+
+        Raises:
+        - RuntimeError: If a shard still fails after `max_retries` retries, once the
+          results of the other shards are yielded.
+        """
+        shards = shard(list(range(len(pairs))), self.shard_size, self.max_shards)
+        pending = list(range(len(shards)))
+        with span(
+            "sharded_inference", articles=len(pairs), shards=len(shards)
+        ) as sharded_span:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    sharded_span.add(retries=len(pending))
+                failed = []
+                results = self.starmap(
+                    [([pairs[i] for i in shards[s]],) for s in pending]
+                )
+                for s, result in zip(pending, results):
+                    if isinstance(result, Exception):
+                        print(
+                            f"Shard {s + 1} of {len(shards)} failed (attempt"
+                            f" {attempt + 1}): {result!r}"
+                        )
+                        failed.append((s, result))
+                    else:
+                        yield from zip(shards[s], result)
+                if not failed:
+                    return
+                pending = [s for s, _ in failed]
+            raise RuntimeError(
+                f"{len(failed)} of {len(shards)} inference shards failed after"
+                f" {self.max_retries} retries."
+            ) from failed[-1][1]
+
+    def stream_infer_stances(self, claim, articles):
+        """Yields (article index, raw result) pairs, like `StanceModel`'s."""
+        yield from self.stream_infer_pairs([(claim, article) for article in articles])
+
+    def batch_infer_stances(self, claim, articles):
+        return [
+            result for _, result in sorted(self.stream_infer_stances(claim, articles))
+        ]
+
+    def batch_infer_pairs(self, pairs):
+        return [result for _, result in sorted(self.stream_infer_pairs(pairs))]
@@ -0,0 +1,276 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from article_cache import CACHE_DIR
+from inference_local import (
+    BACKEND,
+    MAX_CHUNKS,
+    MAX_NEW_TOKENS,
+    MAX_SEQ_LENGTH,
+    PREFIX_CACHE,
+    SAMPLING,
+    STOP_AT_TABLE,
+    TRUNCATION,
+)
+from response_handler import parse_result
+
+
+MODEL_NAME = "Eugenius0/lora_model_tuned"
+MODEL_REVISION = "main"
+# Settings of the inference that change the model response for a given claim and
+# article: how the article is shortened to fit in the prompt, and the generation.
+GENERATION_PARAMS = {
+    **SAMPLING,
+    "backend": BACKEND,
+    "max_seq_length": MAX_SEQ_LENGTH,
+    "max_new_tokens": MAX_NEW_TOKENS,
+    "truncation": TRUNCATION,
+    "max_chunks": MAX_CHUNKS,
+    "stop_at_table": STOP_AT_TABLE,
+    "prefix_cache": PREFIX_CACHE,
+}
+
+
+def normalize_claim(claim):
+    return " ".join(claim.lower().split()).strip(" .!?")
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class MemoryBackend:
+    """In-memory backend keeping the `max_entries` most recently used results."""
+
+    def __init__(self, max_entries=10_000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (model, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][1]
+
+    def put(self, key, model, value):
+        with self._lock:
+            self._entries[key] = (model, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, model=None):
+        with self._lock:
+            if model is None:
+                self._entries.clear()
+            else:
+                for key in [k for k, (m, _) in self._entries.items() if m == model]:
+                    del self._entries[key]
+
+
+class SQLiteBackend:
+    """Persistent backend storing the results in a SQLite database."""
+
+    def __init__(self, directory=CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            os.path.join(directory, "stances.sqlite"), check_same_thread=False
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS stances"
+            " (key TEXT PRIMARY KEY, model TEXT, value TEXT, created_at REAL)"
+        )
+        self._connection.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM stances WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, model, value):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO stances VALUES (?, ?, ?, ?)",
+                (key, model, json.dumps(value), time.time()),
+            )
+            self._connection.commit()
+
+    def delete(self, model=None):
+        with self._lock:
+            if model is None:
+                self._connection.execute("DELETE FROM stances")
+            else:
+                self._connection.execute(
+                    "DELETE FROM stances WHERE model = ?", (model,)
+                )
+            self._connection.commit()
+
+
+class StanceCache:
+    """
+    Cache of stance inference results, in front of `batch_infer_stances`.
+
+    A result is keyed by the normalized claim, the hash of the article content, the
+    model name and revision, and the generation parameters, which include how the
+    content is shortened to the text sent in the prompt (truncation, context size,
+    chunking), so that changing any of them yields new results. The near-duplicates
+    of an article (see `DuplicateIndex`) share its content hash, and thus its
+    results, and the articles of a call sharing a key are inferred once. Cached
+    values hold the raw model response and its parsed form.
+
+    Parameters:
+    - backend: Storage backend, a `MemoryBackend` or a `SQLiteBackend`.
+    - model: Name of the model producing the results.
+    - revision: Revision of the model.
+    - generation_params: Parameters of the generation, and anything else that
+      changes the model response for a given claim and article.
+    - chunking: Whether the model analyzes long articles in chunks.
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        model=MODEL_NAME,
+        revision=MODEL_REVISION,
+        generation_params=GENERATION_PARAMS,
+        chunking=False,
+    ):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.model = model
+        self.revision = revision
+        self.generation_params = {**generation_params, "chunking": chunking}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, claim, article):
+        return content_hash(
+            json.dumps(
+                [
+                    normalize_claim(claim),
+                    article.get("duplicate_of") or content_hash(article["content"]),
+                    self.model,
+                    self.revision,
+                    self.generation_params,
+                ],
+                sort_keys=True,
+            )
+        )
+
+    def get(self, claim, article):
+        """Returns the cached {'raw': ..., 'parsed': ...} value, or None."""
+        value = self.backend.get(self.key(claim, article))
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, claim, article, raw):
+        parsed = parse_result(raw)
+        if parsed["error_flag"]:
+            return  # Don't keep failures, they may not happen again.
+        self.backend.put(
+            self.key(claim, article), self.model, {"raw": raw, "parsed": parsed}
+        )
+
+    def infer(self, claim, articles, batch_infer_stances):
+        """
+        Returns the raw result of every article like `batch_infer_stances`, but only
+        sends the articles missing from the cache to it, once for the articles
+        sharing a key.
+        """
+        results = [None] * len(articles)
+        for i, raw in self.stream(
+            claim,
+            articles,
+            lambda claim, articles: enumerate(batch_infer_stances(claim, articles)),
+        ):
+            results[i] = raw
+        return results
+
+    def infer_pairs(self, pairs, batch_infer_pairs):
+        """
+        Returns the raw result of every (claim, article) pair like
+        `batch_infer_pairs`, but only sends the pairs missing from the cache to it,
+        once even if they appear several times.
+        """
+        results = [None] * len(pairs)
+        missing = {}  # key -> indices of the pairs missing from the cache
+        for i, (claim, article) in enumerate(pairs):
+            value = self.get(claim, article)
+            if value is None:
+                missing.setdefault(self.key(claim, article), []).append(i)
+            else:
+                results[i] = value["raw"]
+
+        if missing:
+            print(f"Stance cache: {len(missing)} misses out of {len(pairs)}.")
+            indices = list(missing.values())
+            missing_results = batch_infer_pairs([pairs[group[0]] for group in indices])
+            for group, raw in zip(indices, missing_results):
+                self.put(*pairs[group[0]], raw)
+                for i in group:
+                    results[i] = raw
+        return results
+
+    def stream(self, claim, articles, stream_infer_stances):
+        """
+        Yields (article index, raw result) pairs as they are available, the cached
+        ones first, then the ones produced by `stream_infer_stances` for the
+        articles missing from the cache, once for the articles sharing a key.
+        """
+        missing = {}  # key -> indices of the articles missing from the cache
+        for i, article in enumerate(articles):
+            value = self.get(claim, article)
+            if value is None:
+                missing.setdefault(self.key(claim, article), []).append(i)
+            else:
+                yield i, value["raw"]
+
+        if missing:
+            print(f"Stance cache: {len(missing)} misses out of {len(articles)}.")
+            groups = list(missing.values())
+            for j, raw in stream_infer_stances(
+                claim, [articles[group[0]] for group in groups]
+            ):
+                self.put(claim, articles[groups[j][0]], raw)
+                for i in groups[j]:
+                    yield i, raw
+
+    def invalidate(self, model=None):
+        """
+        Drops the cached results of `model` (all models if None). To be called when
+        the weights behind a model name change.
+        """
+        self.backend.delete(model)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
+
+
+_stance_cache = None
+_stance_cache_lock = threading.Lock()
+
+
+def get_stance_cache():
+    """Returns the process-wide stance cache, persisted in CACHE_DIR."""
+    global _stance_cache
+    with _stance_cache_lock:
+        if _stance_cache is None:
+            _stance_cache = StanceCache(SQLiteBackend())
+    return _stance_cache
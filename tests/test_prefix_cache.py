@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from benchmark.stub_model import StubModel, StubTokenizer
+from inference_local import PrefixCache, chat_prompt, generate_batch, prompt_prefix
+
+
+class RecordingStubModel(StubModel):
+    """Stub model recording the prompt ids of every `generate` call."""
+
+    def __init__(self, tokenizer):
+        super().__init__(tokenizer, token_latency=0, prefill_latency=0)
+        self.prompts = []
+
+    def generate(self, input_ids, attention_mask=None, **kwargs):
+        self.prompts += [
+            ids[mask.bool()].tolist() for ids, mask in zip(input_ids, attention_mask)
+        ]
+        return super().generate(input_ids, attention_mask=attention_mask, **kwargs)
+
+
+def generate(tokenizer, claim, contents, prefix_cache=None):
+    model = RecordingStubModel(tokenizer)
+    prompts = [
+        chat_prompt(claim, {"content": content}, tokenizer) for content in contents
+    ]
+    stats = {}
+    responses = generate_batch(
+        prompts,
+        (model, tokenizer),
+        stats,
+        prefix=prompt_prefix(claim, tokenizer),
+        prefix_cache=prefix_cache,
+    )
+    return model.prompts, responses, stats
+
+
+@pytest.mark.parametrize(
+    "contents",
+    [
+        ["Coffee is good for you.", "A longer article about coffee and health."],
+        # The whitespace starting the content merges with the end of the prefix.
+        ["\n  Coffee is good for you.", "Coffee again."],
+    ],
+)
+def test_prefix_cache_gives_the_same_ids(contents):
+    tokenizer = StubTokenizer()  # Shared, so that the same tokens have the same ids.
+    claim = "Coffee is healthy"
+    prompts, responses, _ = generate(tokenizer, claim, contents)
+    cached_prompts, cached_responses, _ = generate(
+        tokenizer, claim, contents, PrefixCache()
+    )
+    assert cached_prompts == prompts
+    assert cached_responses == responses
+
+
+def test_prefix_cache_is_used():
+    _, _, stats = generate(
+        StubTokenizer(), "Coffee is healthy", ["Coffee is good."], PrefixCache()
+    )
+    assert stats["cached_prompt_tokens"] > 0
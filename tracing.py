@@ -0,0 +1,278 @@
+import atexit
+import contextvars
+import functools
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+
+# JSON-lines file receiving every finished span, none by default.
+TRACE_FILE = os.environ.get("CLAIM_CHECKER_TRACE_FILE", "")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    A timed stage of the pipeline.
+
+    Spans started while another span is active become its children and share its
+    trace id, so that all the stages of a claim verification can be grouped.
+    Attributes hold the sizes handled by the stage (URLs, bytes, tokens, ...).
+    """
+
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.outcome = "ok"
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def end(self, outcome=None):
+        if self.duration is not None:
+            return
+        if outcome is not None:
+            self.outcome = outcome
+        self.duration = time.time() - self.start
+        record(self)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "outcome": self.outcome,
+            "attributes": self.attributes,
+        }
+
+
+def current_span():
+    """Returns the active span, or None."""
+    return _current_span.get()
+
+
+@contextmanager
+def activate(span):
+    """Makes `span` the parent of the spans started inside the block."""
+    token = _current_span.set(span)
+    try:
+        yield span
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """
+    Times the block as a span named `name`, child of `parent` (the active span by
+    default). The span's outcome is "error" if the block raises.
+    """
+    new_span = Span(name, parent or _current_span.get(), **attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except GeneratorExit:
+        new_span.outcome = "cancelled"
+        raise
+    except BaseException as e:
+        new_span.outcome = "error"
+        new_span.set(error=repr(e))
+        raise
+    finally:
+        try:
+            _current_span.reset(token)
+        except ValueError:
+            pass  # Ended in another context, e.g. a generator resumed elsewhere.
+        new_span.end()
+
+
+def traced(name=None):
+    """Decorator recording every call of the function as a span."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name or function.__name__):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def run_in_context(function):
+    """
+    Wraps `function` so that it runs with the active span as parent, even in another
+    thread (thread pools don't propagate the active span by themselves).
+    """
+    context = contextvars.copy_context()
+    return functools.partial(context.run, function)
+
+
+class JSONLinesSink:
+    """
+    Appends records to a JSON-lines file from a background thread, so that the
+    spans don't wait for the disk. The file is kept open and rotated when it grows
+    beyond `max_bytes`: it is renamed `<path>.1` (the previous one `<path>.2`, ...)
+    and only `backups` old files are kept. Records arriving while `max_pending`
+    records are waiting to be written are dropped.
+    """
+
+    def __init__(self, path, max_bytes=50 * 2**20, backups=2, max_pending=10_000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._file = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        threading.Thread(target=self._run, daemon=True).start()
+        atexit.register(self._queue.join)  # Write the pending records on exit.
+
+    def write(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < 1000:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(records)
+            except OSError as e:
+                print(f"Failed to write {len(records)} spans: {e}")
+                self._file = None
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+    def _write(self, records):
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write(
+            "".join(json.dumps(record, default=str) + "\n" for record in records)
+        )
+        self._file.flush()
+        if self._file.tell() > self.max_bytes:
+            self._file.close()
+            self._file = None
+            for i in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{i}"):
+                    os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+            if self.backups:
+                os.replace(self.path, f"{self.path}.1")
+            else:
+                os.remove(self.path)
+
+
+_sink = JSONLinesSink(TRACE_FILE) if TRACE_FILE else None
+_durations = defaultdict(lambda: deque(maxlen=10_000))  # span name -> durations
+_errors = defaultdict(int)  # span name -> number of failed spans
+_stats_lock = threading.Lock()
+
+
+def configure(path):
+    """Sends the spans to the JSON-lines file at `path`, or nowhere if None."""
+    global _sink
+    _sink = JSONLinesSink(path) if path else None
+
+
+def record(span):
+    with _stats_lock:
+        _durations[span.name].append(span.duration)
+        if span.outcome != "ok":
+            _errors[span.name] += 1
+    if _sink is not None:
+        _sink.write(span.to_dict())
+
+
+def percentile(values, q):
+    """Returns the `q`-th percentile (0-100) of the values, by nearest rank."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(int(round(q / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(durations):
+    return {
+        "count": len(durations),
+        "mean": sum(durations) / len(durations),
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+        "p99": percentile(durations, 99),
+        "max": max(durations),
+    }
+
+
+def summary():
+    """Returns the duration statistics of the spans recorded by this process."""
+    with _stats_lock:
+        return {
+            name: {**summarize(list(durations)), "errors": _errors[name]}
+            for name, durations in _durations.items()
+        }
+
+
+def dump_summary(stats=None, file=sys.stdout):
+    """Prints the duration statistics of every stage as a table."""
+    stats = summary() if stats is None else stats
+    print(
+        f"{'stage':<24}{'count':>8}{'errors':>8}"
+        + "".join(f"{key:>10}" for key in ["mean", "p50", "p95", "p99", "max"]),
+        file=file,
+    )
+    for name, stage in sorted(stats.items()):
+        print(
+            f"{name:<24}{stage['count']:>8}{stage['errors']:>8}"
+            + "".join(
+                f"{stage[key]:>10.3f}" for key in ["mean", "p50", "p95", "p99", "max"]
+            ),
+            file=file,
+        )
+
+
+def summarize_file(path):
+    """Computes the same statistics as `summary` from a JSON-lines trace file."""
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    with open(path) as file:
+        for line in file:
+            span = json.loads(line)
+            durations[span["name"]].append(span["duration"])
+            if span["outcome"] != "ok":
+                errors[span["name"]] += 1
+    return {
+        name: {**summarize(values), "errors": errors[name]}
+        for name, values in durations.items()
+    }
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else TRACE_FILE or "traces.jsonl"
+    dump_summary(summarize_file(path))
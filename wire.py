@@ -0,0 +1,324 @@
+"""
+Compact format of the inference calls, shared by the clients (`WireClient`) and
+the inference workers (`serve_payload`), locally and in the Modal container.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+import threading
+import zlib
+from collections import OrderedDict
+
+from tracing import span
+
+
+# Whether the Modal inference calls use the compact wire format, 0 sends the
+# articles as they are.
+COMPACT_WIRE = os.environ.get("CLAIM_CHECKER_COMPACT_WIRE", "1") != "0"
+INTERACTIVE, BULK = 0, 1  # Request priorities, the lowest is served first.
+CHARS_PER_TOKEN = 6  # Upper bound of the characters per token, to trim articles.
+MAX_CONTENT_CHARS = 100_000_000  # Article contents a worker keeps for later requests.
+
+
+class CharTokenizer:
+    """
+    Stand-in for a tokenizer with one token per character, to shorten articles to a
+    number of characters with the same functions as to a number of tokens.
+    """
+
+    def __call__(self, text, add_special_tokens=False):
+        return {"input_ids": list(text)}
+
+    def decode(self, ids):
+        return "".join(ids)
+
+
+def wire_hash(text):
+    return hashlib.blake2b(text.encode(), digest_size=12).hexdigest()
+
+
+def compress(data, codec=None):
+    """
+    Compresses bytes with zstd (codec b"s") if the zstandard package is installed,
+    else with zlib (codec b"z"), unless the `codec` is given. The first byte tells
+    `decompress` which one was used.
+    """
+    if codec is None:
+        try:
+            import zstandard
+
+            codec = b"s"
+        except ImportError:
+            codec = b"z"
+    if codec == b"s":
+        import zstandard
+
+        return codec + zstandard.ZstdCompressor(level=3).compress(data)
+    return codec + zlib.compress(data, 6)
+
+
+def decompress(data):
+    if data[:1] == b"s":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompress(data[1:])
+    return zlib.decompress(data[1:])
+
+
+def encode_payload(message, codec=None):
+    return compress(json.dumps(message, separators=(",", ":")).encode(), codec)
+
+
+def decode_payload(payload):
+    return json.loads(decompress(payload))
+
+
+def encode_request(pairs, known=(), priority=INTERACTIVE, chunking=False):
+    """
+    Encodes (claim, article) pairs into the compact request of `decode_request`.
+
+    Only the content of the articles is sent, as the prompt uses nothing else,
+    shortened beforehand to what can fit in the context (assuming at most
+    CHARS_PER_TOKEN characters per token) with the same truncation as the worker.
+    Every claim and content is sent once, and the contents whose hash is in `known`
+    (sent to the worker before) are not sent at all.
+
+    Returns:
+    - bytes: The compressed request.
+    - list: The hash of the content of each pair.
+    """
+    # inference_local imports this module.
+    from inference_local import MAX_CHUNKS, MAX_NEW_TOKENS, MAX_SEQ_LENGTH, fit_article
+
+    max_chars = (MAX_SEQ_LENGTH - MAX_NEW_TOKENS) * CHARS_PER_TOKEN
+    if chunking:
+        max_chars *= MAX_CHUNKS
+    tokenizer = CharTokenizer()
+    claims = {}
+    contents = {}
+    references = []
+    hashes = []
+    for claim, article in pairs:
+        if chunking:
+            content = article["content"][:max_chars]
+        else:
+            content = fit_article(claim, article, max_chars, tokenizer)["content"]
+        key = wire_hash(content)
+        if key not in known:
+            contents[key] = content
+        references.append([claims.setdefault(claim, len(claims)), key])
+        hashes.append(key)
+    request = {
+        "claims": list(claims),
+        "contents": contents,
+        "pairs": references,
+        "priority": priority,
+    }
+    return encode_payload(request), hashes
+
+
+class ContentStore:
+    """
+    Article contents received by a worker, by hash, so that the requests don't send
+    them again. The least recently used ones are dropped beyond `max_chars`
+    characters.
+    """
+
+    def __init__(self, max_chars=MAX_CONTENT_CHARS):
+        self.max_chars = max_chars
+        self.chars = 0
+        self._contents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, content):
+        with self._lock:
+            if key not in self._contents:
+                self._contents[key] = content
+                self.chars += len(content)
+            self._contents.move_to_end(key)
+            while self.chars > self.max_chars and len(self._contents) > 1:
+                self.chars -= len(self._contents.popitem(last=False)[1])
+
+    def get(self, key):
+        with self._lock:
+            content = self._contents.get(key)
+            if content is not None:
+                self._contents.move_to_end(key)
+            return content
+
+
+def decode_request(payload, content_store):
+    """
+    Decodes a request of `encode_request`, taking the contents it doesn't hold
+    from the `content_store` and storing the new ones.
+
+    Returns:
+    - list: The (claim, article) pairs, None if some contents are missing.
+    - int: The priority of the request.
+    - list: The hashes of the missing contents.
+    """
+    request = decode_payload(payload)
+    for key, content in request["contents"].items():
+        content_store.add(key, content)
+    pairs = []
+    missing = set()
+    for claim_index, key in request["pairs"]:
+        content = request["contents"].get(key) or content_store.get(key)
+        if content is None:
+            missing.add(key)
+        pairs.append((request["claims"][claim_index], {"content": content}))
+    if missing:
+        return None, request["priority"], sorted(missing)
+    return pairs, request["priority"], []
+
+
+def serve_payload(payload, content_store, stream_infer_pairs):
+    """
+    Answers an encoded request with `stream_infer_pairs(pairs, priority)`, yielding
+    encoded {"results": [[pair index, raw result]]} messages as the results are
+    produced, or a single {"missing": [hashes]} message if the worker doesn't hold
+    some of the contents, which are then to be sent again. The messages are
+    compressed like the request, which the client can thus decompress.
+    """
+    codec = payload[:1]
+    pairs, priority, missing = decode_request(payload, content_store)
+    if missing:
+        yield encode_payload({"missing": missing}, codec)
+        return
+    for i, raw in stream_infer_pairs(pairs, priority):
+        yield encode_payload({"results": [[i, raw]]}, codec)
+
+
+class WireClient:
+    """
+    Client of the `stream_payload` method of the stance model, sending the articles
+    in the compact, compressed requests of `encode_request` instead of pickling the
+    full article dicts.
+
+    The hashes of the last `max_known` contents sent are remembered, and these
+    contents are only referred to by their hash in the next requests. If the worker
+    doesn't hold them (e.g. another container, or one that was restarted), the
+    request is sent again with them. The bytes of every call are logged (at the
+    debug level) and added up in `stats`, along with the size the pickled pairs
+    would have had if `measure_pickled` is set.
+
+    Parameters:
+    - stream_payload: Function yielding the encoded results of an encoded request,
+      like `StanceModel.stream_payload` (its `remote_gen` for Modal).
+    - chunking: Whether the worker analyzes long articles in chunks, which are
+      then not shortened as much.
+    - max_known: Number of content hashes remembered.
+    - measure_pickled: Whether to pickle the pairs of every call to measure the
+      bytes saved, which costs the serialization the wire format avoids (for the
+      benchmark).
+    """
+
+    def __init__(
+        self, stream_payload, chunking=False, max_known=10_000, measure_pickled=False
+    ):
+        self.stream_payload = stream_payload
+        self.chunking = chunking
+        self.max_known = max_known
+        self.measure_pickled = measure_pickled
+        self.calls = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.pickled_bytes = 0
+        self.resent = 0
+        self._known = OrderedDict()  # hashes of the contents sent
+        self._lock = threading.Lock()
+
+    def stream_infer_pairs(self, pairs, priority=INTERACTIVE):
+        """
+        Yields (pair index, raw result) pairs as the results are produced.
+
+        Raises:
+        - RuntimeError: If the worker still misses contents once they were resent.
+        """
+        with span("wire_call", articles=len(pairs)) as call_span:
+            with self._lock:
+                known = set(self._known)
+            request_bytes = response_bytes = 0
+            for _ in range(2):
+                payload, hashes = encode_request(
+                    pairs, known, priority=priority, chunking=self.chunking
+                )
+                request_bytes += len(payload)
+                missing = None
+                for message in self.stream_payload(payload):
+                    response_bytes += len(message)
+                    message = decode_payload(message)
+                    if "missing" in message:
+                        missing = message["missing"]
+                        break
+                    for i, raw in message["results"]:
+                        yield i, raw
+                if missing is None:
+                    break
+                logging.warning(
+                    f"The worker is missing {len(missing)} contents, resending them."
+                )
+                known -= set(missing)
+                with self._lock:
+                    self.resent += len(missing)
+                    for key in missing:
+                        self._known.pop(key, None)
+            else:
+                raise RuntimeError("The inference worker didn't keep the contents.")
+
+            call_span.set(request_bytes=request_bytes, response_bytes=response_bytes)
+            pickled_bytes = 0
+            if self.measure_pickled:
+                pickled_bytes = len(pickle.dumps(pairs))
+                call_span.set(pickled_bytes=pickled_bytes)
+            logging.debug(
+                f"Inference call: {request_bytes} bytes sent, {response_bytes} bytes"
+                " received."
+            )
+            with self._lock:
+                self.calls += 1
+                self.request_bytes += request_bytes
+                self.response_bytes += response_bytes
+                self.pickled_bytes += pickled_bytes
+                for key in hashes:
+                    self._known[key] = True
+                    self._known.move_to_end(key)
+                while len(self._known) > self.max_known:
+                    self._known.popitem(last=False)
+
+    def stream_infer_stances(self, claim, articles, priority=INTERACTIVE):
+        """Yields (article index, raw result) pairs, like `StanceModel`'s."""
+        yield from self.stream_infer_pairs(
+            [(claim, article) for article in articles], priority
+        )
+
+    def batch_infer_stances(self, claim, articles, priority=INTERACTIVE):
+        return [
+            result
+            for _, result in sorted(
+                self.stream_infer_stances(claim, articles, priority)
+            )
+        ]
+
+    def batch_infer_pairs(self, pairs, priority=INTERACTIVE):
+        return [
+            result for _, result in sorted(self.stream_infer_pairs(pairs, priority))
+        ]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "request_bytes": self.request_bytes,
+                "response_bytes": self.response_bytes,
+                "pickled_bytes": self.pickled_bytes if self.measure_pickled else None,
+                "compaction_ratio": (
+                    self.request_bytes / self.pickled_bytes
+                    if self.pickled_bytes
+                    else None
+                ),
+                "resent_contents": self.resent,
+            }